@@ -0,0 +1,263 @@
+# -*- "coding: utf-8" -*-
+
+import argparse
+import csv
+import json
+import logging
+import os
+import platform
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from config import Config
+
+# 各规模的合成数据量；logins 为登录事件数的上限，每次事件展开为1~8条连续的登录记录
+SCALES = {
+    "small": {"users": 1000, "laws": 2000, "views": 50000, "downloads": 10000, "logins": 30000},
+    "medium": {"users": 10000, "laws": 10000, "views": 500000, "downloads": 100000, "logins": 300000},
+    "large": {"users": 100000, "laws": 30000, "views": 5000000, "downloads": 1000000, "logins": 3000000},
+}
+PROVINCES = ["广东", "江苏", "山东", "浙江", "河南", "四川", "北京", "上海"]
+INDUSTRIES = ["建筑", "化工", "电力", "所有行业", "机械,冶金", "矿山", "交通运输", ""]
+DENSE_LIMIT = 20000  # 用户数超过该值时跳过 generate_similarity_matrix 和 AP_cluster（需要 n*n 的相似度矩阵）
+
+
+def _zipf_choice(rng, n, size, exponent):
+    """
+    按幂律分布抽样编号：编号越小被抽中的概率越高，第i个的概率正比于 1/(i+1)**exponent
+    """
+
+    weights = 1.0 / np.arange(1, n+1) ** exponent
+    return rng.choice(n, size=size, p=weights/weights.sum())
+
+
+def generate_data(path, users, laws, views, downloads, logins, seed=0):
+    """
+    在 path 下生成 siteinfo.csv、lawView.csv、lawAttachmentDownload.csv，列与线上导出的数据一致
+
+    用户的活跃度、法律法规的热度均服从幂律分布，省份和行业只有少数几个且分布不均，
+    少量记录的用户名为空、法律法规id为 undefined、位置为 []
+    """
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok=True)
+    usernames = np.array(["138{:08d}".format(i) for i in range(users)], dtype=object)
+    law_ids = np.array(["L{:06d}".format(i) for i in range(laws)], dtype=object)
+
+    # 浏览记录
+    user_id = _zipf_choice(rng, users, views, 1.0)
+    law_id = _zipf_choice(rng, laws, views, 1.1)
+    view = pd.DataFrame({
+            "lawId": np.where(rng.random(views) < 0.01, "undefined", law_ids[law_id]),
+            "nameCN": np.char.add(np.char.add("名称", law_ids[law_id].astype(str)), ",附件"),
+            "classificationTwo": "c",
+            "documentNum": np.char.add("GB", law_id.astype(str)),
+            "pubDate": "", "implDate": "", "isFail": "", "area": "", "departmenttext": "", "nec": "",
+            # 用户所在行业大体固定，偶尔浏览其他行业的文件
+            "industry": np.array(INDUSTRIES, dtype=object)[np.where(rng.random(views) < 0.8, user_id % len(INDUSTRIES),
+                                                                    rng.integers(0, len(INDUSTRIES), views))],
+            "drafttext": "",
+            "openTime": "2020",
+            "username": np.where(rng.random(views) < 0.02, "", usernames[user_id]),
+            "phoneId": "p",
+        })
+    view.to_csv(os.path.join(path, "lawView.csv"), index=False, quoting=csv.QUOTE_ALL, encoding="utf-8")
+
+    # 附件下载记录
+    download = pd.DataFrame({
+            "id": np.arange(downloads),
+            "lawId": law_ids[_zipf_choice(rng, laws, downloads, 1.1)],
+            "username": usernames[_zipf_choice(rng, users, downloads, 1.0)],
+            "createtime": "2020",
+        })
+    download.to_csv(os.path.join(path, "lawAttachmentDownload.csv"), index=False, quoting=csv.QUOTE_ALL, encoding="utf-8")
+
+    # 登录记录：按 BG/NBD 模型的假设生成三个月内的登录事件，每个用户的登录频率服从 Gamma 分布、
+    # 每次登录后流失的概率服从 Beta 分布；事件数超过 logins 时随机抽取 logins 个
+    rate = rng.gamma(0.5, 1.0, users)  # 每天登录的次数
+    dropout = rng.beta(1.0, 3.0, users)
+    counts = np.minimum(rng.geometric(dropout), 500)
+    event_user = np.repeat(np.arange(users), counts)
+    gaps = rng.exponential(1.0, event_user.shape[0]) / rate[event_user]
+    total = np.cumsum(gaps)
+    starts = np.cumsum(counts) - counts
+    offsets = total - np.repeat(total[starts] - gaps[starts], counts)  # 每个用户从活跃期开始的天数
+    event_days = rng.uniform(0, 85, users)[event_user] + offsets
+    event_user = event_user[event_days < 89]
+    event_days = event_days[event_days < 89]
+    if event_user.shape[0] > logins:
+        keep = np.sort(rng.choice(event_user.shape[0], logins, replace=False))
+        event_user, event_days = event_user[keep], event_days[keep]
+    logins = event_user.shape[0]
+    event_time = np.datetime64("2020-05-01T00:00:00") + (event_days * 86400).astype(np.int64).astype("timedelta64[s]")
+    repeats = rng.choice([1, 1, 2, 3, 5, 8], size=logins)
+    login_user = np.repeat(event_user, repeats)
+    login_time = np.repeat(event_time, repeats) \
+        + (np.arange(login_user.shape[0]) - np.repeat(np.cumsum(repeats) - repeats, repeats)).astype("timedelta64[m]")
+    order = np.argsort(login_time, kind="stable")
+    login_user, login_time = login_user[order], login_time[order]
+    # 每个用户主要在一个省份，部分用户经常出差
+    province = np.where(rng.random(login_user.shape[0]) < np.where(login_user % 5 == 0, 0.5, 0.95),
+                        login_user % len(PROVINCES), rng.integers(0, len(PROVINCES), login_user.shape[0]))
+    city = np.char.add(np.char.add(np.array(PROVINCES)[province], rng.integers(0, 3, province.shape[0]).astype(str)), "市")
+    invalid = rng.random(login_user.shape[0]) < 0.02
+    site = pd.DataFrame({
+            "id": np.arange(login_user.shape[0]),
+            "longitude": np.round(rng.uniform(100, 120, login_user.shape[0]), 6),
+            "latitude": np.round(rng.uniform(20, 40, login_user.shape[0]), 6),
+            "createtime": pd.to_datetime(login_time).strftime("%Y/%m/%d %H:%M:%S"),
+            "telphone": usernames[login_user],
+            "telephoneid": "x",
+            "telphoneType": "y",
+            "province": np.where(invalid, "[]", np.array(PROVINCES, dtype=object)[province]),
+            "city": np.where(invalid, "[]", city),
+            "county": "z",
+        })
+    site.to_csv(os.path.join(path, "siteinfo.csv"), index=False, quoting=csv.QUOTE_ALL, encoding="utf-8")
+    return {"lawView": view.shape[0], "lawAttachmentDownload": download.shape[0], "siteinfo": site.shape[0]}
+
+
+class StageProfiler(object):
+    """
+    累计每个步骤的耗时、调用次数和内存峰值（tracemalloc 统计的 Python 和 numpy 分配）
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.stages = defaultdict(lambda: {"seconds": 0.0, "calls": 0, "peak_mb": 0.0})
+
+    @contextmanager
+    def stage(self, name):
+        if self.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = self.stages[name]
+            record["seconds"] += time.perf_counter() - start
+            record["calls"] += 1
+            if self.memory:
+                record["peak_mb"] = max(record["peak_mb"], tracemalloc.get_traced_memory()[1] / 2**20)
+                tracemalloc.stop()
+
+    def call(self, name, func, *args, **kwargs):
+        with self.stage(name):
+            return func(*args, **kwargs)
+
+
+def run_pipeline(profiler):
+    """
+    按 main.py 的顺序运行流程，对各主要步骤计时；其余步骤（保存中间结果等）不计时
+    """
+
+    import cluster_by_category_clv as clv
+    import cluster_by_industry_position as industry_position
+    import recommend_by_similarity as recommend
+    import padding_combine_recommendation as padding
+    from interaction_store import build_store
+
+    os.makedirs("./temp/", exist_ok=True)
+    login_records = profiler.call("load_login_records", clv.load_login_records)
+    category_username = profiler.call("user_division", clv.user_division, login_records)
+    username_clv = profiler.call("cal_clv", clv.cal_clv, login_records)
+    del login_records
+    clv.save_result(category_username, username_clv)
+    profiler.call("build_store", build_store)
+
+    for tag, weights in ((1, (0.7, 0.3)), (2, (0.3, 0.7))):
+        Config.industry_weight, Config.position_weight = weights
+        users = industry_position.filter_users(tag)
+        industry_position.get_user_industry(users)
+        industry_position.get_user_position(users, Config.province_path if tag == 2 else None)
+        users, industry_codes, position_codes = industry_position.load_user_profiles()
+        if len(users) <= DENSE_LIMIT:
+            similarities = profiler.call("generate_similarity_matrix", industry_position.generate_similarity_matrix,
+                                         industry_codes, position_codes)
+            profiler.call("AP_cluster", industry_position.AP_cluster, similarities)
+            del similarities
+        centers, labels = profiler.call("profile_AP_cluster", industry_position.profile_AP_cluster,
+                                        industry_codes, position_codes)
+        industry_position.save_cluster_result(labels, centers, tag, users, industry_codes, position_codes)
+
+        # 与 recommend_by_similarity.run 相同，按簇推荐，每一簇的耗时累计到对应步骤
+        with open("./temp/userid-userlist_cluster{}.csv".format(tag), "r", encoding="utf-8") as f:
+            clusters = [eval(",".join(line.strip().split(",")[2:])) for line in f]
+        with open("./temp/user_recommendation{}.csv".format(tag), "w", encoding="utf-8-sig") as fout:
+            for user_list in clusters:
+                if len(user_list) == 1:
+                    continue
+                user_law_mat, rec_users, laws = profiler.call("load_view_records", recommend.load_view_records, user_list)
+                neighbors = profiler.call("find_neighbors", recommend.find_neighbors, user_law_mat, user_law_mat)
+                profiler.call("recommendation_laws", recommend.recommendation_laws,
+                              user_law_mat, rec_users, laws, fout, neighbors)
+        recommend.convert_recommendation(tag)
+
+    profiler.call("padding", padding.run)
+
+
+def run(scale, workdir, report, seed=0, memory=True):
+    """
+    生成 scale 规模的合成数据，在 workdir 中运行流程，将各步骤的测量结果写入 report
+    """
+
+    sizes = SCALES[scale]
+    workdir = os.path.abspath(workdir)
+    report = os.path.abspath(report)
+    data_path = os.path.join(workdir, "data")
+
+    logging.info("generate {} data: {}".format(scale, sizes))
+    start = time.perf_counter()
+    rows = generate_data(data_path, seed=seed, **sizes)
+    generate_seconds = time.perf_counter() - start
+
+    # 流程中的中间结果均写在当前目录的 ./temp/ 下
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    Config.login_records_path = os.path.join(data_path, "siteinfo.csv")
+    Config.view_records_path = os.path.join(data_path, "lawView.csv")
+    Config.download_records_path = os.path.join(data_path, "lawAttachmentDownload.csv")
+    profiler = StageProfiler(memory)
+    try:
+        start = time.perf_counter()
+        run_pipeline(profiler)
+        total_seconds = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+
+    result = {
+            "scale": scale,
+            "sizes": sizes,
+            "rows": rows,
+            "seed": seed,
+            "memory_profiled": memory,
+            "generate_seconds": round(generate_seconds, 3),
+            "total_seconds": round(total_seconds, 3),
+            "stages": {name: {"seconds": round(record["seconds"], 3), "calls": record["calls"],
+                              "peak_mb": round(record["peak_mb"], 1)} for name, record in profiler.stages.items()},
+            "environment": {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+                            "machine": platform.machine(), "time": time.strftime("%Y-%m-%d %H:%M:%S")},
+        }
+    os.makedirs(os.path.dirname(report), exist_ok=True)
+    with open(report, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    for name, record in result["stages"].items():
+        logging.info("{:<28}{:>10.3f}s{:>8} calls{:>10.1f}MB".format(name, record["seconds"], record["calls"], record["peak_mb"]))
+    return result
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--workdir", default="./temp/benchmark/", help="合成数据和中间结果所在目录")
+    parser.add_argument("--report", default="./temp/benchmark_report.json")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="不统计内存峰值（tracemalloc 会拖慢计时）")
+    args = parser.parse_args()
+    run(args.scale, args.workdir, args.report, args.seed, not args.no_memory)
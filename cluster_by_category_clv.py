@@ -6,15 +6,35 @@ import numpy as np
 from lifetimes.utils import summary_data_from_transaction_data
 from lifetimes import BetaGeoFitter
 from lifetimes import GammaGammaFitter
+from lifetimes.utils import ConvergenceError, _scale_time
 
-import datetime
+import json
 import logging
 import os
 
 from config import Config
+import metrics
 
 
-def user_division():
+def load_login_records():
+    """
+    读取登录记录，user_division 和 cal_clv 共用，只读取一次
+
+    createtime 解析为 datetime64，无法解析的记录被丢弃；city 为 [] 或 []市 的视为缺失
+    """
+
+    login_records = pd.read_csv(
+            Config.login_records_path,
+            usecols=["telphone", "createtime", "city"],
+            na_values={"city": ["[]", "[]市"]},
+            dtype={"telphone": str, "createtime": str, "city": "category"}
+        )
+    login_records["createtime"] = pd.to_datetime(login_records["createtime"], format="%Y/%m/%d %H:%M:%S", errors="coerce")
+    login_records.dropna(subset=["telphone", "createtime"], inplace=True)
+    return login_records
+
+
+def user_division(login_records=None):
     """
     将用户划分为 高级用户、中级用户、初级用户
     
@@ -29,98 +49,172 @@ def user_division():
     1. 下面类似“10次/月”的条件，是针对近一月使用次数的统计
     2. 目前只提供了最近三个月的数据，所以实际只统计了过去三个月内的位置变动情况，
        只要将来提供的数据超过了半年，就将统计半年的数据，不需要修改代码
+
+    Args:
+        login_records: DataFrame  load_login_records 的结果，为 None 时读取
+    Returns:
+        category_username: Series  用户名 -> senior / middle / primary，按用户名排序
     """
 
+    if login_records is None:
+        login_records = load_login_records()
+
     # 统计打开位置
-    login_records = pd.read_csv(
-            Config.login_records_path, 
-            usecols=["telphone", "createtime", "city"], 
-            na_values=["[]", "[]市"], 
-            dtype=str
-        )
-    login_records.dropna(inplace=True)
-    login_records.sort_values(by=["createtime"], inplace=True)
-
-    last_date = login_records.iloc[-1]["createtime"]  # 取数据中的最后一天
-    half_year_ago = datetime.datetime.strftime(
-            datetime.datetime.strptime(last_date, "%Y/%m/%d %H:%M:%S")-datetime.timedelta(days=6*30),
-            "%Y/%m/%d %H:%M:%S"
-        )  # 时间前推 6*30天，作为最近半年数据的分界线
-    login_records = login_records[login_records["createtime"]>half_year_ago]  # 只保留最近半年的数据
-    user_positions = login_records.groupby(by=["telphone"])["city"].unique()  # 按用户名分组，得到每个用户的登录地点
-    user_positions.rename("position", inplace=True)
-
-    # 统计打开频率
-    a_month_ago = datetime.datetime.strftime(
-            datetime.datetime.strptime(last_date, "%Y/%m/%d %H:%M:%S")-datetime.timedelta(days=30),
-            "%Y/%m/%d %H:%M:%S"
-        )  # 时间前推 30天，作为最近一个月数据的分界线
-    a_month_data = login_records[login_records["createtime"]>a_month_ago]  # 过滤出最近一个月的数据
-    user_count = a_month_data.groupby(by=["telphone"]).size()  # 按用户名分组，得到每个用户的登录次数
-    user_count.rename("count", inplace=True)
-
-    # 合并结果
-    table = pd.concat([user_positions, user_count], axis=1).reset_index()
+    login_records = login_records[login_records["city"].notna()]
+    last_date = login_records["createtime"].max()  # 取数据中的最后一天
+    # 时间前推 6*30天，作为最近半年数据的分界线，只保留最近半年的数据
+    login_records = login_records[login_records["createtime"] > last_date - pd.Timedelta(days=6*30)]
+    # 每个用户的登录地点数
+    position_count = login_records.drop_duplicates(subset=["telphone", "city"])["telphone"].value_counts().sort_index()
+
+    # 统计打开频率：时间前推 30天，作为最近一个月数据的分界线；近一月没有登录的用户为 NaN，不满足任何频率条件
+    a_month_data = login_records[login_records["createtime"] > last_date - pd.Timedelta(days=30)]
+    login_count = a_month_data["telphone"].value_counts().reindex(position_count.index)
 
     # 划分用户
-    result = {"senior":set(), "middle":set(), "primary":set()}
-    def loop(line):
-        position_count = len(line["position"])
-        login_count = line["count"]
-        username = line["telphone"]
-        if position_count >= 3 and login_count > 10:
-            result["senior"].add(username)
-        elif (position_count >= 3 and login_count <= 10) or (position_count < 3 and login_count > 5):
-            result["middle"].add(username)
-        else:
-            result["primary"].add(username)
-    table.apply(loop, axis=1)
-    # print(len(result["senior"]), len(result["middle"]), len(result["primary"]))
+    senior = (position_count >= 3) & (login_count > 10)
+    middle = ((position_count >= 3) & (login_count <= 10)) | ((position_count < 3) & (login_count > 5))
+    category_username = pd.Series(
+            np.select([senior, middle], ["senior", "middle"], "primary"), index=position_count.index, name="category")
+    # print(category_username.value_counts())
 
-    return result
+    return category_username
 
 
-def cal_clv():
+def _collapse(summary, columns):
     """
-    计算每个用户的CLV值
+    将 columns 上取值相同的用户合并为一种行为模式
+
+    Returns:
+        patterns: DataFrame  每种行为模式一行，count 列为具有该模式的用户数
+        inverse: ndarray  每个用户对应的行为模式的行号
     """
 
-    # 准备数据
-    login_records = pd.read_csv(
-            Config.login_records_path, 
-            usecols=["telphone", "createtime"], 
-            dtype={"telphone":str, "createtime":str}
-        )
-    login_records.dropna(inplace=True)
-    last_date = datetime.datetime.strptime(login_records.iloc[-1]["createtime"], "%Y/%m/%d %H:%M:%S")
-    last_date = "{}-{}-{}".format(last_date.year, last_date.month, last_date.day)
-    half_year_ago = datetime.datetime.strftime(datetime.datetime.strptime(last_date, "%Y-%m-%d")-datetime.timedelta(days=6*30), "%Y/%m/%d %H:%M:%S")
-    login_records = login_records[login_records["createtime"]>half_year_ago]  # 为保证用户名能一一对应，同样只保留最近半年的数据
-    login_records["monetary_value"] = [1]*login_records.shape[0]  # 用户每登录一次，视为消费金额加1，用于通过GGF计算CLV值
-    login_records.sort_values(by=["createtime"], inplace=True)
+    values, inverse, counts = np.unique(summary[columns].values, axis=0, return_inverse=True, return_counts=True)
+    patterns = pd.DataFrame(values, columns=columns)
+    patterns["count"] = counts
+    return patterns, inverse.ravel()
+
+
+def _load_clv_params():
+    """
+    读取上次拟合的模型参数，用作本次拟合的初始值；没有或不使用时返回空字典
+    """
+
+    if not Config.clv_warm_start or not os.path.exists(Config.clv_params_path):
+        return {}
+    with open(Config.clv_params_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _initial_params(previous, name, T=None):
+    """
+    上次拟合的参数转换为 lifetimes 优化时的初始值：lifetimes 在对数空间中优化，
+    且 BG/NBD 模型中 alpha 按 _scale_time(T) 缩放了时间单位，保存的是缩放前的值
+
+    Returns:
+        ndarray 或 None  没有上次的参数时为 None，使用默认初始值
+    """
+
+    if name not in previous:
+        return None
+    params = dict(previous[name])
+    if T is not None:
+        params["alpha"] *= _scale_time(T)
+    return np.log(list(params.values()))
+
+
+def _fit(fitter, name, initial_params, *args, **kwargs):
+    """
+    拟合一个模型；有初始值时从初始值开始优化，不收敛时再从默认初始值开始
+    """
+
+    if initial_params is not None:
+        try:
+            return fitter.fit(*args, initial_params=initial_params, **kwargs)
+        except ConvergenceError:
+            logging.info("{} did not converge from the previous parameters, refit from scratch".format(name))
+    return fitter.fit(*args, **kwargs)
 
-    # 统计: frequency, recency, T, monetary_value
-    summary = summary_data_from_transaction_data(login_records, "telphone", "createtime", "monetary_value", observation_period_end=last_date)
-    returning_summary = summary[summary["frequency"]>0]  # 只使用frequency大于0的数据对GGF建模
+
+def _fit_clv_models(summary, returning_summary):
+    """
+    拟合 BG/NBD 模型和 Gamma-Gamma 模型
+
+    Config.clv_aggregate 为 True 时，将取值相同的用户合并后以用户数为权重拟合，
+    与逐个用户拟合的似然函数相同，耗时只与不同行为模式的数量有关
+    """
+
+    previous = _load_clv_params()
 
     # BGF模型
     bgf = BetaGeoFitter(penalizer_coef=0)
-    bgf.fit(summary['frequency'], summary['recency'], summary['T'])
+    if Config.clv_aggregate:
+        patterns, _ = _collapse(summary, ["frequency", "recency", "T"])
+        metrics.count(bgf_patterns=patterns.shape[0])
+        _fit(bgf, "bgf", _initial_params(previous, "bgf", patterns['T']), patterns['frequency'], patterns['recency'], patterns['T'], weights=patterns['count'])
+    else:
+        _fit(bgf, "bgf", _initial_params(previous, "bgf", summary['T']), summary['frequency'], summary['recency'], summary['T'])
 
     # GGF模型
     ggf = GammaGammaFitter(penalizer_coef=0)
-    ggf.fit(returning_summary['frequency'], returning_summary['monetary_value'])
+    if Config.clv_aggregate:
+        patterns, _ = _collapse(returning_summary, ["frequency", "monetary_value"])
+        metrics.count(ggf_patterns=patterns.shape[0])
+        _fit(ggf, "ggf", _initial_params(previous, "ggf"), patterns['frequency'], patterns['monetary_value'], weights=patterns['count'])
+    else:
+        _fit(ggf, "ggf", _initial_params(previous, "ggf"), returning_summary['frequency'], returning_summary['monetary_value'])
+
+    with open(Config.clv_params_path, "w", encoding="utf-8") as f:
+        json.dump({"bgf": bgf.params_.to_dict(), "ggf": ggf.params_.to_dict()}, f, indent=2)
+    return bgf, ggf
+
+
+def cal_clv(login_records=None):
+    """
+    计算每个用户的CLV值
+
+    Args:
+        login_records: DataFrame  load_login_records 的结果，为 None 时读取
+    """
+
+    # 准备数据
+    if login_records is None:
+        login_records = load_login_records()
+    last_date = login_records["createtime"].max().normalize()
+    # 为保证用户名能一一对应，同样只保留最近半年的数据
+    login_records = login_records.loc[login_records["createtime"] > last_date - pd.Timedelta(days=6*30), ["telphone", "createtime"]]
+    login_records = login_records.assign(monetary_value=1)  # 用户每登录一次，视为消费金额加1，用于通过GGF计算CLV值
+
+    # 统计: frequency, recency, T, monetary_value
+    summary = summary_data_from_transaction_data(login_records, "telphone", "createtime", "monetary_value", observation_period_end=last_date)
+    returning_summary = summary[summary["frequency"]>0]  # 只使用frequency大于0的数据对GGF建模
+
+    bgf, ggf = _fit_clv_models(summary, returning_summary)
 
     # 计算 clv 值
-    username_clv = ggf.customer_lifetime_value(
-            bgf, # the model to use to predict the number of future transactions
-            summary['frequency'],
-            summary['recency'],
-            summary['T'],
-            summary['monetary_value'],
-            time=12, # months
-            discount_rate=0 # monthly discount rate
-    )
+    if Config.clv_aggregate:  # 每种 (frequency, recency, T, monetary_value) 只计算一次，再按用户展开
+        patterns, inverse = _collapse(summary, ["frequency", "recency", "T", "monetary_value"])
+        pattern_clv = ggf.customer_lifetime_value(
+                bgf,
+                patterns['frequency'],
+                patterns['recency'],
+                patterns['T'],
+                patterns['monetary_value'],
+                time=12,
+                discount_rate=0
+        )
+        username_clv = pd.Series(pattern_clv.values[inverse], index=summary.index, name=pattern_clv.name)
+    else:
+        username_clv = ggf.customer_lifetime_value(
+                bgf, # the model to use to predict the number of future transactions
+                summary['frequency'],
+                summary['recency'],
+                summary['T'],
+                summary['monetary_value'],
+                time=12, # months
+                discount_rate=0 # monthly discount rate
+        )
 
     return username_clv
 
@@ -134,27 +228,23 @@ def save_result(category_username, username_clv):
         category: 高级用户(senior)、中级用户(middle)、初级用户(primary);
         clv: 高CLV(high), 低CLV(low);
         tag: 一类群体(1), 二类群体(2), 三类群体(3);
+    按 senior、middle、primary 的顺序，同一等级内按用户名排序
     """
     
     mean_clv = username_clv.mean()
+    high = (username_clv.reindex(category_username.index) > mean_clv).values  # clv 大于均值的就认为是高 clv
+    category = category_username.values
+    # senior+high 为一类；senior+low、middle+high、primary+high 为二类；middle+low、primary+low 为三类
+    tag = np.select([(category == "senior") & high, (category == "senior") | high], [1, 2], 3)
+    table = pd.DataFrame({
+            "username": category_username.index,
+            "category": category,
+            "clv": np.where(high, "high", "low"),
+            "tag": tag,
+        })
+    order = np.argsort(pd.Categorical(category, categories=["senior", "middle", "primary"]).codes, kind="stable")
     with open("./temp/username-category-clv_table.csv", "w", encoding="utf-8-sig") as f:
-        f.write("username,category,clv,tag\n")
-        for category in category_username:
-            for username in category_username[category]:
-                clv_tag = "high" if username_clv.loc[username] > mean_clv else "low"  # clv 大于均值的就认为是高 clv
-                if category == "senior" and clv_tag == "high":
-                    tag = 1
-                elif category == "senior" and clv_tag == "low":
-                    tag = 2
-                elif category == "middle" and clv_tag == "high":
-                    tag = 2
-                elif category == "middle" and clv_tag == "low":
-                    tag = 3
-                elif category == "primary" and clv_tag == "high":
-                    tag = 2
-                elif category == "primary" and clv_tag == "low":
-                    tag = 3
-                f.write("{},{},{},{}\n".format(username, category, clv_tag, tag))
+        table.iloc[order].to_csv(f, index=False, lineterminator="\n")
 
 
 def run():
@@ -163,12 +253,21 @@ def run():
     if not os.path.exists("./temp/"):
         os.mkdir("./temp/")
 
+    logging.info("load login records...")
+    with metrics.stage("load_login_records"):
+        login_records = load_login_records()
+        metrics.count(rows=login_records.shape[0])
     logging.info("user division...")
-    category_username = user_division()
+    with metrics.stage("user_division"):
+        category_username = user_division(login_records)
+        metrics.count(**{category: int(n) for category, n in category_username.value_counts().items()})
     logging.info("calculate clv...")
-    username_clv = cal_clv()
+    with metrics.stage("cal_clv"):
+        username_clv = cal_clv(login_records)
+        metrics.count(users=username_clv.shape[0])
     logging.info("save result...")
-    save_result(category_username, username_clv)
+    with metrics.stage("save_result"):
+        save_result(category_username, username_clv)
 
 
 if __name__ == "__main__":
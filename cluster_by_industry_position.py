@@ -7,9 +7,52 @@ import logging
 import sys
 
 import numpy as np
+import pandas as pd
 from sklearn.cluster import AffinityPropagation
 
 from config import Config
+from interaction_store import VIEW, load_store, user_ids
+from log_reader import read_chunks
+import metrics
+
+
+def user_industries(store, users=None):
+    """
+    每个用户浏览次数最多的适用行业（不统计 空用户 空行业 和 所有行业），次数相同时取最先出现的行业
+
+    Returns:
+        most_common_users: ndarray  有行业数据的用户编号，从小到大
+        most_common_industries: ndarray  对应的行业编号
+        record_index: ndarray  参与统计的记录的位置
+    """
+
+    industries = store["industries"]
+    user_id = store["user_id"]
+    industry_id = store["industry_id"]
+
+    # 不统计 空用户 空行业 和 所有行业
+    valid_user = store["users"] != ""
+    valid_industry = np.append((industries != "所有行业") & (industries != ""), False)  # 下载记录的行业编号为-1，对应末尾的False
+    mask = (store["source"] == VIEW) & valid_user[user_id] & valid_industry[industry_id]
+    if users != None:  # 只统计当前类别群体（如：一类群体）的数据
+        mask &= np.isin(user_id, user_ids(store, users))
+    record_index = np.nonzero(mask)[0]
+
+    # 统计每个用户在每个行业下的浏览次数，以及每个(用户, 行业)首次出现的位置
+    pairs = user_id[mask].astype(np.int64) * len(industries) + industry_id[mask]
+    pairs, first, counts = np.unique(pairs, return_index=True, return_counts=True)
+    pair_users = pairs // len(industries)
+    pair_industries = pairs % len(industries)
+
+    # 每个用户取浏览次数最多的行业，次数相同时取最先出现的行业
+    order = np.lexsort((first, -counts, pair_users))
+    pair_users, pair_industries = pair_users[order], pair_industries[order]
+    head = np.ones(pair_users.shape[0], dtype=bool)
+    head[1:] = pair_users[1:] != pair_users[:-1]
+    most_common_users = pair_users[head]
+    most_common_industries = pair_industries[head]
+
+    return most_common_users, most_common_industries, record_index
 
 
 def get_user_industry(users=None):
@@ -24,60 +67,78 @@ def get_user_industry(users=None):
     "industry","drafttext","openTime","username","phoneId"
     """
 
-    user_industy_count = defaultdict(lambda :defaultdict(int))
-    with open(Config.view_records_path, "r", encoding="utf-8") as f:
-        columns = [item.replace('"',"") for item in f.readline().strip().split('","')]
-        # username_index = columns.index("phoneId")
-        username_index = columns.index("username")  # 使用 用户名username 而不是 设备编号phoneId 作为 用户标识
-        industry_index = columns.index("industry")
-        for line in f:
-            segments = line.strip().split('","')
-            username = segments[username_index].replace('"',"")
-            industry = segments[industry_index].replace('"',"").replace(",","，").split("，")[0]  # 对于逗号分隔的多个行业只取第一个
-            if users != None and username not in users:  # 只统计当前类别群体（如：一类群体）的数据
-                continue
-            if username != "" and industry != "所有行业" and industry != "":  # 不统计 空用户 空行业 和 所有行业
-                user_industy_count[username][industry] += 1
-
-    # 保存统计结果
+    store = load_store()
+    industries = store["industries"]
+    user_id = store["user_id"]
+    most_common_users, most_common_industries, record_index = user_industries(store, users)
+
+    # 按用户首次出现的顺序保存统计结果
+    _, user_first = np.unique(user_id[record_index], return_index=True)
+    order = np.argsort(user_first)
+    usernames = store["users"][most_common_users[order]].tolist()
+    most_common = industries[most_common_industries[order]].tolist()
     with open("./temp/user_big_table.csv", "w", encoding="utf-8-sig") as f:
-        for username in user_industy_count:
-            most_common_industry = None
-            most_common_count = 0
-            for industry in user_industy_count[username]:
-                cur_count = user_industy_count[username][industry]
-                if most_common_industry is None or cur_count > most_common_count:
-                    most_common_count = cur_count
-                    most_common_industry = industry
-            if most_common_industry is None:  # 没有结果则为所有行业
-                most_common_industry = "所有行业"
+        for username, most_common_industry in zip(usernames, most_common):
             f.write("{},{}\n".format(username, most_common_industry))
 
 
-def get_user_position(users=None):
+def latest_province(users=None):
+    """
+    每个用户最后一次登录的省份（Config.login_records_path），不统计空用户和 [] 异常 等无效省份
+
+    Returns:
+        dict  用户名 -> 省份
+    """
+
+    user_position = {}
+    for chunk, _ in read_chunks(Config.login_records_path, ["telphone", "province"], complete=True):  # 使用 telphone 而不是 phoneId 作为 用户标识
+        chunk = chunk[(chunk["telphone"] != "") & ~chunk["province"].isin(["[]", "", "异常"])]
+        if users is not None:  # 只统计当前类别群体的数据
+            chunk = chunk[chunk["telphone"].isin(users)]
+        chunk = chunk.drop_duplicates(subset="telphone", keep="last")
+        user_position.update(zip(chunk["telphone"].values, chunk["province"].values))  # 只保留最新的结果，相当于只保留最近登录的数据
+
+    return user_position
+
+
+def save_province(user_position, path):
+    """
+    保存每个用户最后一次登录的省份，补齐时按省份分群直接读取，不需要再读取登录数据
+    """
+
+    pd.DataFrame({"username": list(user_position), "province": list(user_position.values())},
+                 columns=["username", "province"]).to_csv(path, index=False, encoding="utf-8-sig")
+
+
+def load_province(path=None):
+    """
+    读取 save_province 保存的省份
+
+    Returns:
+        Series  用户名 -> 省份
+    """
+
+    provinces = pd.read_csv(path or Config.province_path, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    return provinces.set_index("username")["province"]
+
+
+def get_user_position(users=None, province_path=None):
     """
     获取所有用户所在的省份
     
     登录数据（Config.login_records_path）中，记录最后一次登录的省份。
+    province_path 不为 None 时，统计全部用户的省份并保存到 province_path，再从中取出 users 的省份
 
     login_records_path对应的文件包含这些列：
     "id","longitude","latitude","createtime","telphone","telephoneid","telphoneType","province","city","county"
     """
     
-    user_position = defaultdict(str)
-    with open(Config.login_records_path, "r", encoding="utf-8") as f:
-        columns = [item.replace('"',"") for item in f.readline().strip().split(',')]
-        # username_index = columns.index("phoneId")
-        username_index = columns.index("telphone")  # 使用 username 而不是 phoneId 作为 用户标识
-        position_index = columns.index("province")
-        for line in f:
-            segments = line.strip().split(',')
-            username = segments[username_index].replace('"',"")
-            position = segments[position_index].replace('"',"")
-            if users != None and username not in users:  # 只统计当前类别群体的数据
-                continue
-            if username != "" and position not in ("[]", "", "异常"):
-                user_position[username] = position  # 只保留最新的结果，相当于只保留最近登录的数据
+    if province_path is None:
+        user_position = defaultdict(str, latest_province(users))
+    else:  # 同样只读取一次登录数据
+        user_position = latest_province()
+        save_province(user_position, province_path)
+        user_position = defaultdict(str, user_position)
 
     # 保存结果
     with open("./temp/user_big_table1.csv", "w", encoding="utf-8-sig") as fin:
@@ -88,34 +149,65 @@ def get_user_position(users=None):
                 fin.write(new_line)
 
 
-def generate_similarity_matrix():
+def load_user_profiles():
+    """
+    读取用户大表（get_user_position 中生成），将行业和位置编码为整数
+
+    Returns:
+        users: list  用户名
+        industry_codes: ndarray(int32)  行业编码
+        position_codes: ndarray(int32)  位置编码，空位置编码为 -1
+    """
+
+    users, industries, positions = [], [], []
+    with open("./temp/user_big_table1.csv", "r", encoding="utf-8-sig") as f:
+        for line in f:
+            segments = line.strip().split(",")
+            users.append(segments[0])
+            industries.append(segments[1])
+            positions.append(segments[2])
+    industry_codes = pd.factorize(pd.Series(industries, dtype=object))[0].astype(np.int32)
+    position_codes = pd.factorize(pd.Series(positions, dtype=object))[0].astype(np.int32)
+    position_codes[np.array(positions, dtype=object) == ""] = -1
+    return users, industry_codes, position_codes
+
+
+def _similarity_block(block_industry, block_position, industry_codes, position_codes):
+    """
+    计算一批用户与所有用户之间的相似度，返回 len(block) x len(industry_codes) 的 float32 矩阵
+    """
+
+    block_industry = block_industry[:, None]
+    block_position = block_position[:, None]
+    same_industry = block_industry == industry_codes[None, :]  # industry
+    same_position = (block_position == position_codes[None, :]) & (block_position >= 0)  # position (position != "")
+    block = np.where(same_industry, np.float32(Config.industry_weight), np.float32(0))
+    block += np.where(same_position, np.float32(Config.position_weight), np.float32(0))
+    return block
+
+
+def generate_similarity_matrix(industry_codes=None, position_codes=None):
     """
     根据用户所在行业和位置，按照Config中设定的权重，累加分值
 
     如：行业权重0.7，位置权重0.3，初始相似度均为0
     则：当两个用户的行业相同时，两者之间的相似度加 1*0.7
         当两个用户的位置相同时，两者之间的相似度加 1*0.3
+
+    行业和位置先编码为整数，再按 Config.step 行分块广播比较，避免逐对比较；
+    不传入编码时读取用户大表中的全部用户
     """
 
-    data = []
-    with open("./temp/user_big_table1.csv", "r", encoding="utf-8-sig") as f:
-        for line in f:
-            segments = line.strip().split(",")
-            data.append((segments[1], segments[2]))  # (industry, position)
-    n_users = len(data)
-    data_mat = np.zeros((n_users, n_users), dtype=np.float32)
-    cnt = 0
-    for i in range(n_users):
-        cnt += 1
-        print("{}/{}".format(cnt, n_users), end="\r")
-        for j in range(i, n_users):
-            if data[i][0] == data[j][0]:  # industry
-                data_mat[i,j] += 1*Config.industry_weight
-                data_mat[j,i] = data_mat[i,j]
-            if data[i][1] != "" and data[i][1] == data[j][1]:  # position (position != "")
-                data_mat[i,j] += 1*Config.position_weight
-                data_mat[j,i] = data_mat[i,j]
-    print("{}/{}".format(cnt, n_users))
+    if industry_codes is None or position_codes is None:
+        _, industry_codes, position_codes = load_user_profiles()
+    n_users = industry_codes.shape[0]
+    data_mat = np.empty((n_users, n_users), dtype=np.float32)
+    for start in range(0, n_users, Config.step):
+        end = min(start+Config.step, n_users)
+        print("{}/{}".format(end, n_users), end="\r")
+        data_mat[start:end] = _similarity_block(
+                industry_codes[start:end], position_codes[start:end], industry_codes, position_codes)
+    print("{}/{}".format(n_users, n_users))
     
     # with open("./temp/user_similarity_mat.pkl", "wb") as f:  # 保存相似度矩阵
         # pickle.dump(data_mat, f, -1)
@@ -135,13 +227,162 @@ def AP_cluster(similarities, preference=1):
     return centers, labels
   
 
-def save_cluster_result(labels, centers, similarities, tag, users):
+def collapse_profiles(industry_codes, position_codes):
+    """
+    用户之间的相似度只取决于(行业, 位置)组合，将组合相同的用户合并为一个画像
+
+    Returns:
+        profile_industry, profile_position: ndarray  每个画像的行业编码、位置编码
+        counts: ndarray  每个画像包含的用户数
+        profile_index: ndarray  每个用户所属的画像
+    """
+
+    pairs = np.stack([industry_codes, position_codes], axis=1)
+    profiles, profile_index, counts = np.unique(pairs, axis=0, return_inverse=True, return_counts=True)
+    return profiles[:, 0], profiles[:, 1], counts, profile_index.ravel()
+
+
+def weighted_AP_cluster(similarities, weights, preference=1, damping=0.5, max_iter=200, convergence_iter=15):
+    """
+    带权重的近邻传播聚类，每个元素（画像）代表 weights 个相同的用户
+
+    与 sklearn 的 AffinityPropagation 流程一致，区别在于计算 availability 时，
+    每个元素对候选中心的支持按其包含的用户数累加（同一画像中的其他用户也支持该画像作为中心）
+
+    同一画像中其他用户对该画像的相似度是画像自身的相似度 similarities[k, k]（位置为空的画像小于1），
+    而不是 preference，因此这些用户的 responsibility 单独计算，不能用对角线上的 r(k, k) 代替
+    """
+
+    n = similarities.shape[0]
+    weights = np.asarray(weights, dtype=np.float64)
+    S = similarities.astype(np.float64)
+    self_similarity = S.diagonal().copy()
+    S.flat[::n+1] = preference
+    # 与 sklearn 相同，加入极小的噪声去除退化情况，固定随机种子保证结果可复现
+    random_state = np.random.RandomState(0)
+    S += (np.finfo(S.dtype).eps * S + np.finfo(S.dtype).tiny * 100) * random_state.standard_normal(size=(n, n))
+
+    A = np.zeros((n, n))
+    R = np.zeros((n, n))
+    R_peer = np.zeros(n)  # 画像中其他用户对该画像的 responsibility
+    e = np.zeros((n, convergence_iter))
+    ind = np.arange(n)
+    for it in range(max_iter):
+        # responsibility
+        AS = A + S
+        I = np.argmax(AS, axis=1)
+        Y = AS[ind, I]
+        AS[ind, I] = -np.inf
+        Y2 = np.max(AS, axis=1)
+        # 画像中其他用户与该画像的行相同，除该画像外的最大值即为 Y（最大值不在对角线上时）或 Y2
+        Y_peer = np.where(I == ind, Y2, Y)
+        tmp = S - Y[:, None]
+        tmp[ind, I] = S[ind, I] - Y2
+        R = damping * R + (1 - damping) * tmp
+        R_peer = damping * R_peer + (1 - damping) * (self_similarity - Y_peer)
+
+        # availability，支持度按用户数加权
+        positive = np.maximum(R, 0)
+        support = positive * weights[:, None]
+        diag = R.flat[::n+1]
+        support.flat[::n+1] = diag + (weights - 1) * np.maximum(R_peer, 0)
+        total = support.sum(axis=0)
+        tmp = np.minimum(total[None, :] - positive, 0)
+        tmp.flat[::n+1] = total - diag
+        A = damping * A + (1 - damping) * tmp
+
+        # 中心点连续 convergence_iter 次不变则认为收敛
+        E = (np.diag(A) + np.diag(R)) > 0
+        e[:, it % convergence_iter] = E
+        K = np.sum(E)
+        if it >= convergence_iter:
+            se = np.sum(e, axis=1)
+            unconverged = np.sum((se == convergence_iter) + (se == 0)) != n
+            if (not unconverged and K > 0) or it == max_iter - 1:
+                break
+
+    I = np.flatnonzero(E)
+    if I.shape[0] == 0:  # 没有中心点时，每个元素单独一类
+        return ind, ind
+    c = np.argmax(S[:, I], axis=1)
+    c[I] = np.arange(I.shape[0])
+    for k in range(I.shape[0]):  # 每一簇中选出加权相似度之和最大的元素作为中心
+        members = np.flatnonzero(c == k)
+        j = np.argmax(np.dot(weights[members], S[np.ix_(members, members)]))
+        I[k] = members[j]
+    c = np.argmax(S[:, I], axis=1)
+    c[I] = np.arange(I.shape[0])
+    labels = c
+    centers = I
+    return centers, labels
+
+
+def profile_AP_cluster(industry_codes, position_codes, preference=1):
+    """
+    先将用户合并为(行业, 位置)画像，对画像做带权重的近邻传播聚类，再将结果展开到用户
+
+    Returns:
+        centers: ndarray  每一簇中心的用户下标（中心画像的第一个用户）
+        labels: ndarray  每个用户所属簇的编号
+    """
+
+    profile_industry, profile_position, counts, profile_index = collapse_profiles(industry_codes, position_codes)
+    logging.info("{} users -> {} profiles".format(industry_codes.shape[0], counts.shape[0]))
+    similarities = generate_similarity_matrix(profile_industry, profile_position)
+    profile_centers, profile_labels = weighted_AP_cluster(similarities, counts, preference)
+    first_user = np.full(counts.shape[0], -1, dtype=np.int64)
+    first_user[profile_index[::-1]] = np.arange(profile_index.shape[0])[::-1]  # 每个画像的第一个用户
+    return first_user[profile_centers], profile_labels[profile_index]
+
+
+def cluster_stats(labels, industry_codes, position_codes):
+    """
+    统计每一簇的大小，以及簇内两两用户之间相似度的均值、最小值、最大值
+
+    行业相同的用户对数可由每一簇中各行业的人数直接算出（k个人两两组合共 k*(k-1)/2 对），位置同理，
+    因此均值不需要枚举用户对；最小值、最大值只需比较簇内出现的(行业, 位置)画像
+    """
+
+    n_clusters = labels.max() + 1 if labels.shape[0] else 0
+    sizes = np.bincount(labels, minlength=n_clusters)
+
+    def same_pairs(codes, valid):
+        # 每一簇中取值相同的用户对数
+        base = codes.max() + 1 if codes.shape[0] else 1
+        keys, counts = np.unique(labels[valid].astype(np.int64) * base + codes[valid], return_counts=True)
+        return np.bincount(keys // base, weights=counts * (counts - 1) / 2, minlength=n_clusters)
+
+    pairs = sizes * (sizes - 1) / 2
+    sums = Config.industry_weight * same_pairs(industry_codes, np.ones(labels.shape[0], dtype=bool)) \
+        + Config.position_weight * same_pairs(position_codes, position_codes >= 0)
+    means = np.where(sums > 0, sums / np.maximum(pairs, 1), 0).astype(np.float32)
+
+    # 每一簇中的(行业, 位置)画像及其人数
+    profiles, counts = np.unique(np.stack([labels, industry_codes, position_codes], axis=1), axis=0, return_counts=True)
+    bounds = np.searchsorted(profiles[:, 0], np.arange(n_clusters + 1))
+    mins = np.zeros(n_clusters)
+    maxs = np.zeros(n_clusters)
+    for label in range(n_clusters):
+        if sizes[label] < 2:
+            continue
+        start, end = bounds[label], bounds[label+1]
+        industry, position = profiles[start:end, 1], profiles[start:end, 2]
+        similarity = _similarity_block(industry, position, industry, position)
+        valid = ~np.eye(end - start, dtype=bool)
+        valid[np.diag_indices(end - start)] = counts[start:end] > 1  # 同一画像中至少有两个用户才构成用户对
+        mins[label] = similarity[valid].min()
+        maxs[label] = similarity[valid].max()
+    return sizes, means, mins, maxs
+
+
+def save_cluster_result(labels, centers, tag, users, industry_codes, position_codes):
     """
     保存聚类结果
 
     结果包含这几列：
     簇内的第一个用户名（用于标识每一簇）, 簇内用户的相似度均值, 簇内的所有用户名列表
 
+    每一簇的统计数据（大小、相似度均值、最小值、最大值）另存为 cluster_stats{tag}.csv
     """
 
     result = {}
@@ -151,18 +392,16 @@ def save_cluster_result(labels, centers, similarities, tag, users):
     for idx, label in enumerate(labels):
         result[label2center[label]].append(idx)
 
+    sizes, means, mins, maxs = cluster_stats(np.asarray(labels), industry_codes, position_codes)
     print("save csv file...")
     with open("./temp/userid-userlist_cluster{}.csv".format(tag), "w", encoding="utf-8") as f:
-        for center, line in result.items():
-            t_similarities = []
-            for i in range(len(line)):
-                for j in range(i+1, len(line)):
-                    t_similarities.append(similarities[line[i]][line[j]])
-            if sum(t_similarities) == 0:
-                t_mean = 0
-            else:
-                t_mean = np.mean(t_similarities)
+        for label, (center, line) in enumerate(result.items()):
+            t_mean = means[label] if means[label] > 0 else 0
             f.write("{},{},{}\n".format(users[center], t_mean, list(map(lambda x: users[x], line))))
+    with open("./temp/cluster_stats{}.csv".format(tag), "w", encoding="utf-8") as f:
+        f.write("center,size,mean_similarity,min_similarity,max_similarity\n")
+        for label, center in enumerate(result):
+            f.write("{},{},{},{},{}\n".format(users[center], sizes[label], means[label], mins[label], maxs[label]))
     return result
 
 
@@ -193,16 +432,30 @@ def run(tag):
     else:
         print("Invalid tag value: {}, tag should in (1, 2)".format(tag), file=sys.stderr)
 
+    metrics.count(users=len(users))
     logging.info("get user industry...")
-    get_user_industry(users)
+    with metrics.stage("get_user_industry"):
+        get_user_industry(users)
     logging.info("get user position...")
-    get_user_position(users)
-    logging.info("generate similarity matrix...")
-    similarities = generate_similarity_matrix()
-    print(similarities.shape)
-    logging.info("AP cluster and save result...")
-    centers, labels = AP_cluster(similarities)
-    save_cluster_result(labels, centers, similarities, tag, users)
+    with metrics.stage("get_user_position"):
+        get_user_position(users, Config.province_path if tag == 2 else None)  # 全部用户的省份在二类群体聚类时保存，供补齐使用
+    # 相似度矩阵的行对应用户大表中的用户（只包含有行业数据的用户）
+    users, industry_codes, position_codes = load_user_profiles()
+    metrics.count(profiled_users=len(users))
+    if Config.profile_cluster:
+        logging.info("AP cluster on profiles and save result...")
+        with metrics.stage("profile_AP_cluster"):
+            centers, labels = profile_AP_cluster(industry_codes, position_codes)
+    else:
+        logging.info("generate similarity matrix...")
+        with metrics.stage("generate_similarity_matrix"):
+            similarities = generate_similarity_matrix(industry_codes, position_codes)
+        print(similarities.shape)
+        logging.info("AP cluster and save result...")
+        with metrics.stage("AP_cluster"):
+            centers, labels = AP_cluster(similarities)
+    metrics.count(clusters=len(centers))
+    save_cluster_result(labels, centers, tag, users, industry_codes, position_codes)
 
 
 if __name__ == "__main__":
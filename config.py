@@ -4,13 +4,46 @@ class Config(object):
     login_records_path = "../data/20200729/siteinfo.csv"  # 用户登录记录所在路径
     view_records_path = "../data/20200729/lawView.csv"  # 用户浏览记录所在路径
     download_records_path = "../data/20200729/lawAttachmentDownload.csv"  # 用户附件下载记录所在路径
-    result_path = "./recommendation_cn.csv"  # 推荐结果保存路径
+    result_path = "./recommendation_cn.csv"  # 推荐结果保存路径（CSV）
+    result_table_path = "./recommendation_cn.feather"  # 推荐结果保存路径（列式存储，后缀为 .feather 或 .parquet，需要 pyarrow）
+    export_csv = True  # 是否同时将推荐结果保存为CSV（Config.result_path）
+    popular_laws_path = "./temp/popular_laws.csv"  # 热门法律法规保存路径，在线服务用于补齐
+    province_path = "./temp/user_province.csv"  # 全部用户最后一次登录的省份，二类群体聚类时保存，补齐时按省份分群使用
+    store_path = "./temp/interaction_store.npz"  # 浏览记录和下载记录的列式存储路径
+    matrix_path = "./temp/user_law_matrix.npz"  # 全体用户的偏好矩阵保存路径，增量更新时在此基础上累加
+    stage_cache_path = "./temp/stage_cache.json"  # main.py 中各步骤的输入摘要和产出摘要
+    metrics_path = "./temp/metrics.json"  # 各步骤的耗时、内存峰值和数据量统计
 
     industry_weight = 0.7
     position_weight = 0.3
     view_weight = 0.5
     download_weight = 0.5
 
+    clv_aggregate = True  # 将 (frequency, recency, T, monetary_value) 相同的用户合并后加权拟合CLV模型
+    clv_warm_start = True  # 以上次拟合的参数作为本次拟合CLV模型的初始值
+    clv_params_path = "./temp/clv_params.json"  # 上次拟合的CLV模型参数
+
+    # 将(行业, 位置)相同的用户合并为画像后再聚类，适合用户数多到无法计算全体用户相似度矩阵的情况；
+    # 结果与对全体用户聚类不同：画像相同的用户总在同一簇，每个画像至多一簇（对全体用户聚类时相同的用户可能被分到不同的簇），
+    # 簇的数量和每一簇的成员（即推荐时的邻居范围）都会改变。False 时对全部用户的相似度矩阵聚类
+    profile_cluster = False
+
     n_neighbors = 50
     n_recommendation = 10
+    popular_segments = ["industry", "province", "category"]  # 补齐时依次使用用户所在的 行业/省份/等级 分群的热门法律法规，都没有时使用全局热门；[] 为都使用全局热门
     step = 2000
+    dump_neighbors = False  # 调试用：是否将用户的邻居列表保存到 ./temp/user_neighbors.csv
+    out_of_core = False  # 大簇模式：每一簇的偏好矩阵、候选矩阵和邻居列表按 step 行一块写入 memmap_dir 中的内存映射文件，相似度按 step×step 分块计算；全体用户的偏好矩阵（global_matrix 为 True 时）和每个用户一项的数组仍在内存中
+    memmap_dir = "./temp/memmap/"  # 大簇模式下内存映射文件所在目录，每个进程一个子目录
+    global_matrix = True  # 只构建一次全体用户的偏好矩阵，每一簇按行截取；False 时每一簇单独构建
+    workers = 1  # 按簇并行推荐的进程数，1 为串行
+    chunk_bytes = 64 << 20  # 分块读取日志时每块的字节数
+    reader_workers = 1  # 分块读取日志时解析各块的进程数，1 为在当前进程中解析
+    convert_chunk_rows = 1000000  # convert_recommendation 每次转换的推荐结果行数
+    stage_cache = True  # 输入和相关设置都没有变化的步骤跳过不运行；False 时（或 main.py --force）所有步骤都重新运行
+    drift_threshold = 0.1  # 增量更新时，新增记录数或新增用户数超过上次全量构建时的这一比例，则重新聚类
+    profile_stage = None  # 用 cProfile 分析的步骤名，如 "recommend1" 或 "cluster1/get_user_position"；None 为不分析
+
+    serve_host = "127.0.0.1"  # 推荐服务监听的地址
+    serve_port = 8080  # 推荐服务监听的端口
+    serve_reload_interval = 5  # 推荐服务每隔多少秒检查一次推荐结果是否更新
@@ -2,9 +2,17 @@
 
 import numpy as np
 import copy
+import argparse
+import json
+import os
 import requests
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import xlsxwriter
+from scipy.spatial import cKDTree
 
 api = 'https://restapi.amap.com/v3/geocode/regeo'
 # 只需要一个密钥
@@ -21,108 +29,465 @@ keys = (
         "49ea5b64a8e6c2ff7594160d31fdfa69",  # key8
         "c9fde9674bdb8ab7b3770d71c0e4aac4",  # key9
     )
-key_pool = (key for key in keys)
-key = ''
 filepath = "../data/20200729/siteinfo.csv"
 savepath = "../data/20200729/siteinfo-1.csv"
 batch_size = 20
+chunk_size = 100000  # 离线逆地理编码每次处理的行数
+# 区县中心点坐标，用于离线逆地理编码，包含列：province,city,district,longitude,latitude
+district_centroids_path = "../data/district_centroids.csv"
+max_distance = 100  # 离线逆地理编码时，与最近的区县中心点距离超过该值（公里）则视为无效坐标
+earth_radius = 6371.0
+online_chunk_size = 2000  # 在线逆地理编码每次处理的行数，按输入顺序写出
+max_in_flight = 4  # 同时进行中的请求数
+key_quota = 6000  # 每把密钥每日可调用次数
+key_qps = 3  # 每把密钥每秒最多调用次数
+max_retries = 3  # 请求失败后的重试次数
+retry_backoff = 0.5  # 第n次重试前等待 retry_backoff * 2**(n-1) 秒
+request_timeout = 10
+checkpoint_every = 1  # 每处理多少批保存一次检查点（检查点保存在 savepath + ".checkpoint"）
+cache_path = "../data/geocode_cache.sqlite"  # 逆地理编码结果缓存，跨天复用
+cache_precision = 4  # 缓存按坐标保留的小数位数匹配，4位约为10米
 
 log = open("log.txt", "a", encoding="utf-8", buffering=1)
 
-def coordinate2address(longitudes, latitudes, step):
+QUOTA_INFOCODES = ("10001", "10003", "10044")  # 密钥无效、超出日调用量，需要更换密钥
+RATE_INFOCODES = ("10004", "10014", "10019", "10020", "10021")  # 访问过于频繁，稍后重试
 
-    provinces = []
-    cities = []
-    districts = []
 
-    coordinates = "|".join(
-            [str(round(longitude, 6))+","+str(round(latitude, 6)) for longitude, latitude in zip(longitudes, latitudes)])
-    
-    try:
-        response = requests.get(api, params={"key": key, "location": coordinates, "batch": "true"}).json()
-        if len(response["regeocodes"]) != step:
-            raise Exception("contains invalid coordinate.")
-    except Exception as e:
-        print(type(e), ":", e, file=log)
-        # exit(1)
-        return (["[]"]*step, ["[]"]*step, ["[]"]*step)
-    for regeocode in response["regeocodes"]:
-        province = str(regeocode["addressComponent"]["province"])[:2]  # eg: 新疆
-        city = str(regeocode["addressComponent"]["city"])
-        if city == "[]":
-            city = province + "市"
-        district = str(regeocode["addressComponent"]["district"])
-
-        provinces.append(province)
-        cities.append(city)
-        districts.append(district)
+class QuotaExhausted(Exception):
+    """
+    所有密钥当日的调用量均已用完
+    """
+
+
+class KeyPool(object):
+    """
+    密钥池：按密钥记录当日调用次数并限制调用频率，密钥用完或失效时自动换用下一把，跨天后重新计数
+    """
+
+    def __init__(self, keys, quota=None, qps=None):
+        self.keys = list(keys)
+        self.quota = quota or key_quota
+        self.interval = 1.0 / (qps or key_qps)
+        self.lock = threading.Lock()
+        self._reset(datetime.now().date())
+
+    def _reset(self, day):
+        self.day = day
+        self.used = {key: 0 for key in self.keys}
+        self.next_time = {key: 0.0 for key in self.keys}
+        self.disabled = set()
+
+    def acquire(self):
+        """
+        取一把可用的密钥，必要时等待以满足调用频率限制
+        """
+
+        with self.lock:
+            if datetime.now().date() != self.day:
+                self._reset(datetime.now().date())
+            available = [key for key in self.keys if key not in self.disabled and self.used[key] < self.quota]
+            if not available:
+                raise QuotaExhausted("all keys are exhausted today.")
+            key = min(available, key=lambda item: self.next_time[item])  # 优先使用最早可用的密钥
+            now = time.monotonic()
+            wait = max(self.next_time[key] - now, 0)
+            self.next_time[key] = max(self.next_time[key], now) + self.interval
+            self.used[key] += 1
+        if wait > 0:
+            time.sleep(wait)
+        return key
+
+    def disable(self, key):
+        """
+        密钥失效或当日调用量已用完，不再使用
+        """
+
+        with self.lock:
+            self.disabled.add(key)
+
+    def report(self):
+        return {key: self.used[key] for key in self.keys}
+
+
+class RegeoClient(object):
+    """
+    高德逆地理编码批量请求客户端：复用连接池，失败后按指数退避重试，线程安全
+    """
+
+    def __init__(self, key_pool, url=None, pool_size=None):
+        self.key_pool = key_pool
+        self.url = url or api
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _request(self, coordinates, step):
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                time.sleep(retry_backoff * 2**(attempt-1))
+            key = self.key_pool.acquire()
+            try:
+                response = self.session.get(
+                        self.url, params={"key": key, "location": coordinates, "batch": "true"}, timeout=request_timeout)
+                response.raise_for_status()
+                response = response.json()
+            except (requests.RequestException, ValueError) as e:
+                print(type(e), ":", e, file=log)
+                continue
+            if str(response.get("status")) != "1":
+                infocode = str(response.get("infocode"))
+                print("regeo failed:", infocode, response.get("info"), file=log)
+                if infocode in QUOTA_INFOCODES:  # 换一把密钥重试，不计入重试次数
+                    self.key_pool.disable(key)
+                    return self._request(coordinates, step)
+                continue
+            if len(response["regeocodes"]) != step:  # 含有无效坐标，重试也无法成功
+                print(ValueError, ":", "contains invalid coordinate.", file=log)
+                return None
+            return response
+        return None
+
+    def regeo(self, longitudes, latitudes):
+        """
+        一次请求解析最多 batch_size 个坐标，返回 (省, 市, 区) 列表；重试后仍失败的结果为 "[]"
+        """
+
+        step = len(longitudes)
+        coordinates = "|".join(
+                [str(round(longitude, 6))+","+str(round(latitude, 6)) for longitude, latitude in zip(longitudes, latitudes)])
+        response = self._request(coordinates, step)
+        if response is None:
+            return (["[]"]*step, ["[]"]*step, ["[]"]*step)
+
+        provinces = []
+        cities = []
+        districts = []
+        for regeocode in response["regeocodes"]:
+            province = str(regeocode["addressComponent"]["province"])[:2]  # eg: 新疆
+            city = str(regeocode["addressComponent"]["city"])
+            if city == "[]":
+                city = province + "市"
+            district = str(regeocode["addressComponent"]["district"])
+
+            provinces.append(province)
+            cities.append(city)
+            districts.append(district)
+
+        return provinces, cities, districts
+
 
+def coordinate2address(longitudes, latitudes, step, client=None):
+
+    client = client or RegeoClient(KeyPool(keys))
+    return client.regeo(longitudes[:step], latitudes[:step])
+
+
+def geocode_concurrently(longitudes, latitudes, client, executor):
+    """
+    将坐标按 batch_size 分批，用线程池并发请求，结果按输入顺序返回
+    """
+
+    batches = [(longitudes[start:start+batch_size], latitudes[start:start+batch_size])
+               for start in range(0, len(longitudes), batch_size)]
+    provinces, cities, districts = [], [], []
+    for batch_provinces, batch_cities, batch_districts in executor.map(lambda batch: client.regeo(*batch), batches):
+        provinces.extend(batch_provinces)
+        cities.extend(batch_cities)
+        districts.extend(batch_districts)
     return provinces, cities, districts
 
-def process_data():
 
-    global key
-    key = next(key_pool)  # 获取第一把密钥
+class GeocodeCache(object):
+    """
+    逆地理编码结果的持久化缓存（SQLite），以保留 precision 位小数的坐标为键，只缓存成功的结果
+    """
 
-    with open(savepath, "w", encoding="utf-8", buffering=1) as fout:
-        with open(filepath, "r", encoding="utf-8") as fin:
-            fout.write(fin.readline())  # 跳过第一行
+    def __init__(self, path=None, precision=None):
+        self.precision = cache_precision if precision is None else precision
+        self.table = "geocode_{}".format(self.precision)  # 不同精度的结果分表保存
+        self.connection = sqlite3.connect(path or cache_path)
+        self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS {} (longitude INTEGER, latitude INTEGER, "
+                "province TEXT, city TEXT, district TEXT, PRIMARY KEY (longitude, latitude))".format(self.table))
+        self.hits = 0  # 命中缓存的行数
+        self.misses = 0  # 未命中缓存的行数
+        self.resolved = 0  # 去重后实际解析的坐标数
 
-            line_cnt = 0
-            line_total = 1081571
-            request_cnt = 0
-            
+    def keys(self, longitudes, latitudes):
+        """
+        坐标转换为缓存的键，无效坐标的键为 None
+        """
+
+        scale = 10 ** self.precision
+        return [(int(round(longitude * scale)), int(round(latitude * scale)))
+                if np.isfinite(longitude) and np.isfinite(latitude) else None
+                for longitude, latitude in zip(longitudes, latitudes)]
+
+    def get_many(self, keys):
+        result = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 400):
+            batch = keys[start:start+400]
+            rows = self.connection.execute(
+                    "SELECT longitude, latitude, province, city, district FROM {} WHERE (longitude, latitude) IN (VALUES {})"
+                    .format(self.table, ",".join(["(?,?)"]*len(batch))),
+                    [value for key in batch for value in key])
+            for longitude, latitude, province, city, district in rows:
+                result[(longitude, latitude)] = (province, city, district)
+        return result
+
+    def put_many(self, items):
+        with self.connection:
+            self.connection.executemany(
+                    "INSERT OR REPLACE INTO {} VALUES (?,?,?,?,?)".format(self.table),
+                    [key + value for key, value in items if value[0] != "[]"])
+
+    def report(self):
+        return {"hits": self.hits, "misses": self.misses, "resolved": self.resolved}
+
+    def close(self):
+        self.connection.close()
+
+
+def cached_resolver(resolve, cache):
+    """
+    为 resolve(longitudes, latitudes) 加上缓存：先查缓存，只对去重后的未命中坐标调用 resolve
+    """
+
+    def cached_resolve(longitudes, latitudes):
+        keys = cache.keys(longitudes, latitudes)
+        unique_keys = set(key for key in keys if key is not None)
+        found = cache.get_many(unique_keys)
+        missing = sorted(unique_keys - set(found))
+        hits = sum(1 for key in keys if key in found)
+        cache.hits += hits
+        cache.misses += len(keys) - hits
+        cache.resolved += len(missing)
+
+        if missing:
+            scale = 10 ** cache.precision
+            provinces, cities, districts = resolve([key[0] / scale for key in missing], [key[1] / scale for key in missing])
+            resolved = list(zip(missing, zip(provinces, cities, districts)))
+            cache.put_many(resolved)
+            found.update(resolved)
+
+        invalid = [index for index, key in enumerate(keys) if key is None]  # 无效坐标仍交给 resolve 处理
+        if invalid:
+            results = resolve([longitudes[index] for index in invalid], [latitudes[index] for index in invalid])
+            for index, province, city, district in zip(invalid, *results):
+                keys[index] = ("invalid", index)
+                found[keys[index]] = (province, city, district)
+
+        results = [found[key] for key in keys]
+        return [item[0] for item in results], [item[1] for item in results], [item[2] for item in results]
+
+    return cached_resolve
+
+
+def process_data(url=None, use_cache=True, resume=False):
+    """
+    调用高德逆地理编码接口补齐省市区：每 online_chunk_size 行一批，批内的请求并发进行，按输入顺序写出
+
+    use_cache 为 True 时，相同位置（按 cache_precision 位小数）只请求一次，结果保存在 cache_path 中供以后复用；
+    resume 为 True 时从上次中断时保存的检查点继续
+    """
+
+    client = RegeoClient(KeyPool(keys), url=url)
+    cache = GeocodeCache() if use_cache else None
+
+    line_total = 1081571
+    progress = lambda line_cnt, end: print(
+            "{}/{}, {}".format(line_cnt, line_total, sum(client.key_pool.report().values())), end=end)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        resolve = lambda longitudes, latitudes: geocode_concurrently(longitudes, latitudes, client, executor)
+        if cache is not None:
+            resolve = cached_resolver(resolve, cache)
+        _process_chunks(resolve, online_chunk_size, resume, progress)
+    if cache is not None:
+        print("geocode cache:", cache.report())
+        cache.close()
+
+
+def _to_unit_vectors(longitudes, latitudes):
+    """
+    经纬度转换为单位球面上的三维坐标，使k-d树中的欧氏距离与球面距离单调对应
+    """
+
+    longitudes = np.radians(longitudes)
+    latitudes = np.radians(latitudes)
+    return np.stack([
+            np.cos(latitudes) * np.cos(longitudes),
+            np.cos(latitudes) * np.sin(longitudes),
+            np.sin(latitudes),
+        ], axis=1)
+
+
+def load_district_index(path=None):
+    """
+    读取区县中心点坐标，构建k-d树
+
+    省、市的处理方式与 coordinate2address 一致：省份只保留前两个字，没有市（直辖市）时市为 省份+"市"
+    """
+
+    provinces, cities, districts, longitudes, latitudes = [], [], [], [], []
+    with open(path or district_centroids_path, "r", encoding="utf-8-sig") as f:
+        columns = [item.replace('"',"") for item in f.readline().strip().split(",")]
+        indices = [columns.index(name) for name in ("province", "city", "district", "longitude", "latitude")]
+        for line in f:
+            segments = line.replace('"',"").strip().split(",")
+            province, city, district, longitude, latitude = [segments[index] for index in indices]
+            province = province[:2]  # eg: 新疆
+            if city in ("[]", ""):
+                city = province + "市"
+            provinces.append(province)
+            cities.append(city)
+            districts.append(district)
+            longitudes.append(float(longitude))
+            latitudes.append(float(latitude))
+    tree = cKDTree(_to_unit_vectors(np.array(longitudes), np.array(latitudes)))
+    return tree, np.array(provinces, dtype=object), np.array(cities, dtype=object), np.array(districts, dtype=object)
+
+
+def coordinate2address_offline(longitudes, latitudes, index):
+    """
+    离线逆地理编码，返回结果与 coordinate2address 相同；无效坐标的结果为 "[]"
+
+    index 为 load_district_index 的返回结果
+    """
+
+    tree, district_provinces, district_cities, district_districts = index
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    valid = np.isfinite(longitudes) & np.isfinite(latitudes) & (np.abs(latitudes) <= 90) & (np.abs(longitudes) <= 180)
+    provinces = np.full(longitudes.shape[0], "[]", dtype=object)
+    cities = provinces.copy()
+    districts = provinces.copy()
+    if valid.any():
+        chord, nearest = tree.query(_to_unit_vectors(longitudes[valid], latitudes[valid]))
+        distance = 2 * earth_radius * np.arcsin(np.minimum(chord / 2, 1))  # 弦长换算为球面距离
+        rows = np.flatnonzero(valid)[distance <= max_distance]
+        nearest = nearest[distance <= max_distance]
+        provinces[rows] = district_provinces[nearest]
+        cities[rows] = district_cities[nearest]
+        districts[rows] = district_districts[nearest]
+    return provinces.tolist(), cities.tolist(), districts.tolist()
+
+
+def _parse_coordinate(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def _iter_chunks(fin, size):
+    """
+    按行读取登录数据（二进制方式打开），每次返回 size 行，每行去掉引号后按逗号切分
+    """
+
+    lines = []
+    for line in fin:
+        lines.append(line.decode("utf-8").replace('"',"").strip().split(","))
+        if len(lines) == size:
+            yield lines
             lines = []
-            batch = []
-            line_count = 0
-            for line in fin:
+    if lines:
+        yield lines
+
+
+def _fill_chunk(lines, resolve):
+    """
+    为一批行中缺少省市区（"异常" 或 空）的行补齐结果，resolve(longitudes, latitudes) 返回 (省, 市, 区) 列表
+    """
+
+    pending = [item for item in lines if item[-3] in ["异常", ""]]  # 跳过已有数据
+    if not pending:
+        return
+    longitudes = [_parse_coordinate(item[1]) for item in pending]
+    latitudes = [_parse_coordinate(item[2]) for item in pending]
+    provinces, cities, districts = resolve(longitudes, latitudes)
+    for item, province, city, district in zip(pending, provinces, cities, districts):
+        item[-3] = province
+        item[-2] = city
+        item[-1] = district
+
+
+def _save_checkpoint(path, input_offset, output_offset, line_cnt):
+    """
+    保存检查点：输入、输出文件中已处理完的位置。先写临时文件再替换，避免检查点本身损坏
+    """
+
+    state = {"filepath": filepath, "savepath": savepath,
+             "input_offset": input_offset, "output_offset": output_offset, "lines": line_cnt}
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def _process_chunks(resolve, size, resume=False, progress=None):
+    """
+    逐批读取 filepath、补齐省市区并写入 savepath，每 checkpoint_every 批保存一次检查点
+
+    resume 为 True 且检查点存在时，直接跳到检查点记录的位置继续处理，已写出的结果不再重复计算；
+    全部处理完后删除检查点
+    """
+
+    checkpoint = savepath + ".checkpoint"
+    state = None
+    if resume:
+        if os.path.exists(checkpoint):
+            with open(checkpoint, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state["filepath"] != filepath or state["savepath"] != savepath:
+                raise ValueError("checkpoint {} does not match {} -> {}".format(checkpoint, filepath, savepath))
+        else:
+            print("no checkpoint found, start from the beginning.")
+
+    with open(filepath, "rb") as fin:
+        header = fin.readline()
+        if state is not None:
+            fin.seek(state["input_offset"])
+            fout = open(savepath, "r+b")
+            fout.truncate(state["output_offset"])  # 丢弃检查点之后未确认的输出
+            fout.seek(state["output_offset"])
+            line_cnt = state["lines"]
+        else:
+            fout = open(savepath, "wb")
+            fout.write(header)  # 跳过第一行
+            line_cnt = 0
+
+        with fout:
+            chunk_cnt = 0
+            for lines in _iter_chunks(fin, size):
+                _fill_chunk(lines, resolve)
+                fout.write("".join(",".join(item)+"\n" for item in lines).encode("utf-8"))
+                line_cnt += len(lines)
+                chunk_cnt += 1
+                if chunk_cnt % checkpoint_every == 0:
+                    fout.flush()
+                    os.fsync(fout.fileno())
+                    _save_checkpoint(checkpoint, fin.tell(), fout.tell(), line_cnt)
+                if progress is not None:
+                    progress(line_cnt, "\r")
+            if progress is not None:
+                progress(line_cnt, "\n")
+
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+def process_data_offline(resume=False):
+    """
+    使用本地的区县中心点坐标离线补齐省市区，不调用高德接口，输出格式与 process_data 一致
+    """
 
-                line = line.replace('"',"")
-
-                line_cnt += 1
-                print("{}/{}, {}".format(line_cnt, line_total, request_cnt), end="\r")
-
-                segments = line.strip().split(",")
-                lines.append(segments)
-                if segments[-3] not in ["异常", ""]:  # 跳过已有数据
-                    continue
-                batch.append(segments[1:3])
-                line_count += 1
-                if line_count == batch_size: # 凑够20个再一起处理
-                    longitudes = [float(item[0]) for item in batch]
-                    latitudes = [float(item[1]) for item in batch]
-                    provinces, cities, districts = coordinate2address(longitudes, latitudes, line_count)
-                    i = 0
-                    for item in lines:
-                        if item[-3] in ["异常", ""]:
-                            item[-3] = provinces[i]
-                            item[-2] = cities[i]
-                            item[-1] = districts[i]
-                            i += 1
-                        fout.write(",".join(item)+"\n")
-                    lines = []
-                    batch = []
-                    line_count = 0
-                    request_cnt += 1
-                    # 更新高德地图密钥
-                    # if request_cnt % 5000 == 0:
-                        # key = next(key_pool)
-
-            if len(batch) > 0:  # 处理结尾部分
-                longitudes = [float(item[0]) for item in batch]
-                latitudes = [float(item[1]) for item in batch]
-                provinces, cities, districts = coordinate2address(longitudes, latitudes, line_count)
-                i = 0
-                for item in lines:
-                    if item[-3] in ["异常", ""]:
-                        item[-3] = provinces[i]
-                        item[-2] = cities[i]
-                        item[-1] = districts[i]
-                        i += 1
-                    fout.write(",".join(item)+"\n")
-                lines = []
-                batch = []
-                line_count = 0
+    index = load_district_index()
+    resolve = lambda longitudes, latitudes: coordinate2address_offline(longitudes, latitudes, index)
+    _process_chunks(resolve, chunk_size, resume, lambda line_cnt, end: print("{}".format(line_cnt), end=end))
 
 
 def padding_file():
@@ -155,6 +520,13 @@ def find_difference():
 
 
 if __name__ == "__main__":
-    process_data()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", action="store_true", help="从上次中断时保存的检查点继续")
+    parser.add_argument("--offline", action="store_true", help="使用本地区县中心点坐标离线补齐")
+    args = parser.parse_args()
+    if args.offline:
+        process_data_offline(resume=args.resume)
+    else:
+        process_data(resume=args.resume)
     # padding_file()
     # find_difference()
@@ -0,0 +1,286 @@
+# -*- "coding: utf-8" -*-
+
+import hashlib
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from config import Config
+from log_reader import read_chunks, read_header
+import metrics
+
+VIEW = 0  # 浏览记录
+DOWNLOAD = 1  # 附件下载记录
+VIEW_COLUMNS = ["lawId", "nameCN", "documentNum", "industry", "username"]
+DOWNLOAD_COLUMNS = ["lawId", "username"]
+TAIL_SIZE = 4096  # 记录已读取部分末尾这么多字节的摘要，用于判断日志是否只是在末尾追加
+
+_cache = {}  # 同一进程内复用已加载的存储，避免重复读取
+
+
+def _tail_digest(path, end):
+    """
+    日志中 end 之前 TAIL_SIZE 个字节的摘要
+    """
+
+    with open(path, "rb") as f:
+        f.seek(max(end - TAIL_SIZE, 0))
+        return hashlib.md5(f.read(end - max(end - TAIL_SIZE, 0))).hexdigest()
+
+
+def _intern(values, vocabulary):
+    """
+    将取值转换为编号；vocabulary 为 取值 -> 编号 的字典，新出现的取值按首次出现的顺序追加到其中
+
+    每块只在字典中查找这一块中不同的取值，不随已有取值的增多而变慢
+    """
+
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    mapping = np.fromiter((vocabulary.setdefault(value, len(vocabulary)) for value in uniques),
+                          dtype=np.int32, count=len(uniques))
+    return mapping[codes]
+
+
+def _ingest(store, chunks):
+    """
+    将逐块读取的浏览记录、下载记录追加到存储中（store 为空的存储时即为全量构建）
+
+    每块只转换为编号，各数组的各块在最后拼接一次
+
+    Args:
+        chunks: 可迭代对象，每项为 (source, frame)，frame 为一块浏览记录（source 为 VIEW）或下载记录（DOWNLOAD）
+    """
+
+    users = {user: code for code, user in enumerate(store["users"].tolist())}
+    laws = {law: code for code, law in enumerate(store["laws"].tolist())}
+    industries = {industry: code for code, industry in enumerate(store["industries"].tolist())}
+    law_names = store["law_names"].tolist()
+    law_nums = store["law_nums"].tolist()
+    # 还没有浏览记录的法律法规（如只出现在下载记录中），在之后的浏览记录中首次出现时再取中文名、标准号，
+    # 与全量构建（先读取全部浏览记录）的结果一致
+    unviewed = set(np.setdiff1d(np.arange(len(laws)), store["law_id"][store["source"] == VIEW]).tolist())
+    columns = {name: [store[name]] for name in ("user_id", "law_id", "weight", "source", "industry_id")}
+
+    for source, frame in chunks:
+        n_laws = len(laws)
+        user_id = _intern(frame["username"], users)
+        law_id = _intern(frame["lawId"], laws)
+        law_names.extend([""] * (len(laws) - n_laws))
+        law_nums.extend([""] * (len(laws) - n_laws))
+        unviewed.update(range(n_laws, len(laws)))
+
+        if source == VIEW:
+            # 对于逗号分隔的多个行业只取第一个
+            industry_id = _intern(frame["industry"].str.replace(",", "，").str.split("，").str[0], industries)
+            # 第一次有浏览记录的法律法规，取浏览记录中首次出现的中文名、标准号
+            first_view = pd.DataFrame({
+                    "law": law_id,
+                    "name": frame["nameCN"].values,
+                    "num": frame["documentNum"].values,
+                }).drop_duplicates(subset="law")
+            first_view = first_view[first_view["law"].isin(unviewed).values]
+            for law, name, num in zip(first_view["law"].tolist(), first_view["name"].tolist(), first_view["num"].tolist()):
+                law_names[law] = name
+                law_nums[law] = num
+                unviewed.discard(law)
+        else:
+            industry_id = np.full(user_id.shape[0], -1, dtype=np.int32)
+
+        columns["user_id"].append(user_id)
+        columns["law_id"].append(law_id)
+        columns["weight"].append(np.full(user_id.shape[0], Config.view_weight if source == VIEW else Config.download_weight,
+                                         dtype=np.float32))
+        columns["source"].append(np.full(user_id.shape[0], source, dtype=np.int8))
+        columns["industry_id"].append(industry_id)
+
+    result = dict(store)
+    result.update({name: np.concatenate(arrays) for name, arrays in columns.items()})
+    result.update(
+            users=np.asarray(list(users), dtype=str),
+            laws=np.asarray(list(laws), dtype=str),
+            industries=np.asarray(list(industries), dtype=str),
+            law_names=np.asarray(law_names, dtype=str),
+            law_nums=np.asarray(law_nums, dtype=str),
+        )
+    return result
+
+
+def _ingest_logs(store, view_offset=0, download_offset=0, complete=False):
+    """
+    分别从 view_offset、download_offset 字节处开始逐块读取浏览记录和下载记录，追加到存储中
+
+    全量构建时 complete 为 True，末尾没有换行符的一行也读取；增量更新时这一行可能还没写完，留到下次读取
+
+    Returns:
+        store: dict  追加后的存储
+        ends: dict  VIEW/DOWNLOAD -> 读取结束的位置，下次从这里继续读取
+    """
+
+    ends = {}
+
+    def chunks():
+        for source, path, columns, offset in ((VIEW, Config.view_records_path, VIEW_COLUMNS, view_offset),
+                                              (DOWNLOAD, Config.download_records_path, DOWNLOAD_COLUMNS, download_offset)):
+            ends[source] = offset or read_header(path)[1]
+            for frame, end in read_chunks(path, columns, offset, complete=complete):
+                ends[source] = end
+                yield source, frame
+
+    return _ingest(store, chunks()), ends
+
+
+def _save_store(store):
+    np.savez(Config.store_path, **{name: value for name, value in store.items() if name != "user_index"})
+    _cache.clear()
+
+
+def build_store():
+    """
+    一次性读取浏览记录和下载记录，保存为列式存储，供后续各个步骤直接加载
+
+    存储包含这些数组：
+        user_id, law_id: 每条记录的用户编号、法律法规编号（int32，按首次出现的顺序编号）
+        weight: 每条记录的分值（按Config中设置的浏览/下载权重）
+        source: 记录来源，VIEW(0) 或 DOWNLOAD(1)
+        industry_id: 浏览记录的适用行业编号（只取第一个行业），下载记录为 -1
+        users, laws, industries: 编号对应的用户名、法律法规id、行业名
+        law_names, law_nums: 每项法律法规的中文名、标准号（取浏览记录中首次出现的值）
+    以及增量更新用到的：
+        view_offset, download_offset: 两份日志已读取到的位置
+        view_tail, download_tail: 两份日志已读取部分末尾的摘要
+        generation: 全量构建的编号，增量更新时不变
+        base_records, base_users: 全量构建时的记录数、用户数，用于衡量此后增量数据的多少
+    """
+
+    empty = {
+            "user_id": np.zeros(0, dtype=np.int32),
+            "law_id": np.zeros(0, dtype=np.int32),
+            "weight": np.zeros(0, dtype=np.float32),
+            "source": np.zeros(0, dtype=np.int8),
+            "industry_id": np.zeros(0, dtype=np.int32),
+            "users": np.zeros(0, dtype=str),
+            "laws": np.zeros(0, dtype=str),
+            "industries": np.zeros(0, dtype=str),
+            "law_names": np.zeros(0, dtype=str),
+            "law_nums": np.zeros(0, dtype=str),
+        }
+    store, ends = _ingest_logs(empty, complete=True)
+    view_offset, download_offset = ends[VIEW], ends[DOWNLOAD]
+    store.update(
+            view_offset=np.int64(view_offset),
+            download_offset=np.int64(download_offset),
+            view_tail=np.str_(_tail_digest(Config.view_records_path, view_offset)),
+            download_tail=np.str_(_tail_digest(Config.download_records_path, download_offset)),
+            generation=np.int64(time.time_ns()),
+            base_records=np.int64(store["user_id"].shape[0]),
+            base_users=np.int64(store["users"].shape[0]),
+        )
+    _save_store(store)
+    metrics.count(records=store["user_id"].shape[0], users=len(store["users"]), laws=len(store["laws"]))
+    logging.info("interaction store: {} records, {} users, {} laws".format(
+            store["user_id"].shape[0], len(store["users"]), len(store["laws"])))
+
+
+def _appendable(store, path, offset_name, tail_name):
+    """
+    日志是否只是在上次读取的位置之后追加了新记录
+    """
+
+    offset = int(store[offset_name])
+    return os.path.getsize(path) >= offset and _tail_digest(path, offset) == str(store[tail_name])
+
+
+def update_store():
+    """
+    增量更新列式存储：只读取两份日志在上次读取位置之后追加的记录
+
+    日志不是单纯追加（被截断、替换或修改）或存储不存在时，改为全量构建
+
+    Returns:
+        dict: rebuilt 是否全量构建；users 有新记录的用户名列表；records 新增的记录数
+    """
+
+    if not os.path.exists(Config.store_path):
+        build_store()
+        return {"rebuilt": True, "users": [], "records": 0}
+    store = _read_store()
+    if "view_offset" not in store \
+            or not _appendable(store, Config.view_records_path, "view_offset", "view_tail") \
+            or not _appendable(store, Config.download_records_path, "download_offset", "download_tail"):
+        build_store()
+        return {"rebuilt": True, "users": [], "records": 0}
+
+    n_records = store["user_id"].shape[0]
+    store, ends = _ingest_logs(store, int(store["view_offset"]), int(store["download_offset"]))
+    view_offset, download_offset = ends[VIEW], ends[DOWNLOAD]
+    if store["user_id"].shape[0] == n_records:
+        os.utime(Config.store_path)  # 没有新记录，只更新存储的修改时间
+        return {"rebuilt": False, "users": [], "records": 0}
+    store.update(
+            view_offset=np.int64(view_offset),
+            download_offset=np.int64(download_offset),
+            view_tail=np.str_(_tail_digest(Config.view_records_path, view_offset)),
+            download_tail=np.str_(_tail_digest(Config.download_records_path, download_offset)),
+        )
+    _save_store(store)
+
+    new_users = np.unique(store["user_id"][n_records:])
+    metrics.count(new_records=store["user_id"].shape[0] - n_records, new_users=new_users.shape[0])
+    logging.info("interaction store: {} new records from {} users".format(store["user_id"].shape[0] - n_records, new_users.shape[0]))
+    return {"rebuilt": False, "users": store["users"][new_users].tolist(), "records": store["user_id"].shape[0] - n_records}
+
+
+def drift(store):
+    """
+    自上次全量构建以来，新增记录数、新增用户数所占比例中的较大者
+    """
+
+    records = (store["user_id"].shape[0] - int(store["base_records"])) / max(int(store["base_records"]), 1)
+    users = (store["users"].shape[0] - int(store["base_users"])) / max(int(store["base_users"]), 1)
+    return max(records, users)
+
+
+def _read_store():
+    key = (Config.store_path, os.stat(Config.store_path).st_mtime_ns)
+    if key not in _cache:
+        _cache.clear()
+        with np.load(Config.store_path) as data:
+            _cache[key] = {name: data[name] for name in data.files}
+    return _cache[key]
+
+
+def load_store():
+    """
+    加载列式存储，不存在时全量构建，比浏览/下载记录旧时增量更新
+    """
+
+    log_mtime = max(os.path.getmtime(Config.view_records_path), os.path.getmtime(Config.download_records_path))
+    if not os.path.exists(Config.store_path):
+        build_store()
+    elif os.path.getmtime(Config.store_path) < log_mtime:
+        update_store()
+    return _read_store()
+
+
+def user_ids(store, usernames):
+    """
+    将用户名列表转换为存储中的用户编号，不在存储中的用户名被忽略
+    """
+
+    if "user_index" not in store:
+        store["user_index"] = {username: idx for idx, username in enumerate(store["users"].tolist())}
+    user_index = store["user_index"]
+    return np.array([user_index[username] for username in usernames if username in user_index], dtype=np.int32)
+
+
+def valid_records(store):
+    """
+    有效的用户-法律法规记录：用户名不为空，且法律法规id不为 undefined
+    """
+
+    valid_user = store["users"] != ""
+    valid_law = store["laws"] != "undefined"
+    return valid_user[store["user_id"]] & valid_law[store["law_id"]]
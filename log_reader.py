@@ -0,0 +1,111 @@
+# -*- "coding: utf-8" -*-
+
+import csv
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from config import Config
+
+
+def read_header(path):
+    """
+    读取日志的表头
+
+    Returns:
+        names: list  列名
+        size: int  表头所占的字节数（包括换行符）
+    """
+
+    with open(path, "rb") as f:
+        header = f.readline()
+    return next(csv.reader([header.decode("utf-8-sig")])), len(header)
+
+
+def _parse(data, names, columns, dtype, options):
+    """
+    用 pandas 的 CSV 解析器解析一块只包含完整行的数据，正确处理引号和字段中的逗号
+    """
+
+    if not data.strip():  # 只有空行，如上次读取到没有换行符的最后一行，之后只追加了换行符
+        return empty_frame(columns)
+    return pd.read_csv(io.BytesIO(data), header=None, names=names, usecols=columns, dtype=dtype,
+                       keep_default_na=False, encoding="utf-8", **options)
+
+
+def _blocks(path, start, chunk_bytes, complete=False):
+    """
+    从 start 字节处开始，每次读取约 chunk_bytes 个字节，截断到最后一个换行符，
+    不完整的部分留到下一块；文件末尾没有换行符的一行，complete 为 True 时作为最后一块读取，
+    否则视为还没写完，不读取
+
+    Yields:
+        data: bytes  只包含完整行的一块数据（complete 为 True 时最后一块可能没有换行符）
+        end: int  这一块结束的位置
+    """
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        rest = b""
+        end = start
+        for block in iter(lambda: f.read(chunk_bytes), b""):
+            data = rest + block
+            cut = data.rfind(b"\n") + 1
+            data, rest = data[:cut], data[cut:]
+            if data:
+                end += len(data)
+                yield data, end
+        if complete and rest.strip():
+            yield rest, end + len(rest)
+
+
+def read_chunks(path, columns, offset=0, dtype=str, chunk_bytes=None, workers=None, complete=False, **options):
+    """
+    分块读取CSV日志，内存占用取决于块的大小而不是文件大小
+
+    每条记录占一行（字段中可以有带引号的逗号，但不能有换行符）。
+
+    Args:
+        path: str  日志路径，第一行为表头
+        columns: list  只读取这些列
+        offset: int  从这个字节位置开始读取（上次读取结束的位置），为 0 时从表头之后开始
+        dtype: 各列的类型，默认均为字符串；其他参数（如 parse_dates）原样传给 pd.read_csv
+        chunk_bytes: int  每块的字节数，默认为 Config.chunk_bytes
+        workers: int  解析各块的进程数，默认为 Config.reader_workers；大于 1 时按顺序返回各块
+        complete: bool  日志是否已经写完：为 True 时（全量读取）末尾没有换行符的一行也读取；
+                        为 False 时（读取仍在追加的日志）不读取，留到下次从 end 处继续读取
+
+    Yields:
+        frame: DataFrame  一块中的记录，只包含 columns 中的列
+        end: int  这一块结束的位置，下次从这里继续读取
+    """
+
+    names, header_size = read_header(path)
+    chunk_bytes = chunk_bytes or Config.chunk_bytes
+    workers = workers or Config.reader_workers
+    blocks = _blocks(path, offset or header_size, chunk_bytes, complete)
+
+    if workers <= 1:
+        for data, end in blocks:
+            yield _parse(data, names, columns, dtype, options), end
+        return
+
+    # 最多同时有 2*workers 块在解析，保证内存占用有上限
+    with ProcessPoolExecutor(workers) as pool:
+        pending = []
+        for data, end in blocks:
+            pending.append((pool.submit(_parse, data, names, columns, dtype, options), end))
+            if len(pending) >= 2 * workers:
+                future, end = pending.pop(0)
+                yield future.result(), end
+        for future, end in pending:
+            yield future.result(), end
+
+
+def empty_frame(columns):
+    """
+    没有记录时的空表，各列均为字符串类型
+    """
+
+    return pd.DataFrame({name: pd.Series([], dtype=object) for name in columns})
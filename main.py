@@ -1,19 +1,154 @@
 # -*- "coding: utf-8" -*-
 
+import argparse
+import hashlib
+import json
 import logging
+import os
 
 from cluster_by_category_clv import run as first_cluster
+from interaction_store import build_store, drift, load_store, update_store
 from cluster_by_industry_position import run as second_cluster
 from recommend_by_similarity import run as do_recommend
-from padding_combine_recommendation import run as padding_result
+from padding_combine_recommendation import result_paths, run as padding_result
 from config import Config
+import metrics
+
+CLV_TABLE = "./temp/username-category-clv_table.csv"
+
+
+def _file_digest(path, files):
+    """
+    文件内容的摘要；files 中记录了上次计算时的 [大小, 修改时间, 摘要]，文件未变化时直接复用
+    """
+
+    stat = os.stat(path)
+    cached = files.get(path)
+    if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return cached[2]
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    files[path] = [stat.st_size, stat.st_mtime_ns, md5.hexdigest()]
+    return files[path][2]
+
+
+def run_stage(manifest, name, func, inputs, fields, outputs, *args):
+    """
+    运行一个步骤；输入文件和相关的Config项都没有变化、且上次的产出文件没有被改动时跳过
+
+    Args:
+        manifest: dict  各步骤上次运行的记录，保存在 Config.stage_cache_path
+        name: str  步骤名
+        func: 步骤函数，以 args 为参数调用
+        inputs: list  步骤读取的文件
+        fields: list  影响步骤结果的Config项
+        outputs: list  步骤产出、供后续步骤读取的文件
+    """
+
+    files = manifest.setdefault("files", {})
+    key = hashlib.md5(json.dumps({
+            "args": args,
+            "inputs": {path: _file_digest(path, files) for path in inputs},
+            "config": {field: getattr(Config, field) for field in fields},
+        }, sort_keys=True).encode("utf-8")).hexdigest()
+
+    record = manifest.setdefault("stages", {}).get(name)
+    if Config.stage_cache and record is not None and record["key"] == key and set(outputs) <= set(record["outputs"]) \
+            and all(os.path.exists(path) and _file_digest(path, files) == digest for path, digest in record["outputs"].items()):
+        logging.info("stage {} is up to date, skip".format(name))
+        metrics.skip(name)
+        return
+
+    with metrics.stage(name):
+        func(*args)
+    manifest["stages"][name] = {"key": key, "outputs": {path: _file_digest(path, files) for path in outputs}}
+    with open(Config.stage_cache_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def pipeline():
+    """
+    完整流程：每一步只在它的输入文件或相关设置变化时重新运行，上游的产出变化时下游随之重新运行
+    """
+
+    if not os.path.exists("./temp/"):
+        os.mkdir("./temp/")
+    manifest = {}
+    if os.path.exists(Config.stage_cache_path):
+        with open(Config.stage_cache_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    run_stage(manifest, "clv", first_cluster, [Config.login_records_path], ["clv_aggregate"], [CLV_TABLE])
+    # 浏览记录和下载记录只读取一次，后续步骤均从列式存储加载
+    run_stage(manifest, "store", build_store, [Config.view_records_path, Config.download_records_path],
+              ["view_weight", "download_weight"], [Config.store_path])
+    # 一类群体使用 config.py 中设置的行业/位置权重，二类群体固定为 0.3/0.7
+    for tag, weights in ((1, (Config.industry_weight, Config.position_weight)), (2, (0.3, 0.7))):
+        Config.industry_weight, Config.position_weight = weights
+        cluster_path = "./temp/userid-userlist_cluster{}.csv".format(tag)
+        run_stage(manifest, "cluster{}".format(tag), second_cluster,
+                  [Config.store_path, Config.login_records_path, CLV_TABLE],
+                  ["industry_weight", "position_weight", "profile_cluster"],
+                  [cluster_path, "./temp/cluster_stats{}.csv".format(tag)] + ([Config.province_path] if tag == 2 else []), tag)
+        run_stage(manifest, "recommend{}".format(tag), do_recommend,
+                  [Config.store_path, cluster_path], ["n_neighbors", "n_recommendation"],
+                  ["./temp/user_recommendation{}.csv".format(tag), "./temp/recommendation_cn{}.csv".format(tag)], tag)
+    run_stage(manifest, "padding", padding_result,
+              [Config.store_path, Config.province_path, CLV_TABLE, "./temp/recommendation_cn1.csv", "./temp/recommendation_cn2.csv"],
+              ["n_recommendation", "popular_segments", "result_path", "result_table_path", "export_csv"], result_paths() + [Config.popular_laws_path])
+
+
+def incremental():
+    """
+    增量更新：只读取日志中新增的记录，沿用上次的聚类结果，只为包含有新记录的用户的簇重新推荐
+
+    存储需要全量构建（日志被截断或替换）、或自上次全量构建以来新增的记录/用户超过 Config.drift_threshold 时，
+    返回 False，改为运行完整流程
+    """
+
+    with metrics.stage("update_store"):
+        delta = update_store()
+    if delta["rebuilt"]:
+        logging.info("interaction store rebuilt, run the full pipeline")
+        return False
+    store_drift = drift(load_store())
+    if store_drift > Config.drift_threshold:
+        logging.info("drift {:.3f} > {}, run the full pipeline".format(store_drift, Config.drift_threshold))
+        return False
+    if not all(os.path.exists("./temp/userid-userlist_cluster{}.csv".format(tag)) for tag in (1, 2)) \
+            or not os.path.exists(Config.province_path):
+        return False
+
+    logging.info("drift {:.3f}, {} users with new records".format(store_drift, len(delta["users"])))
+    with metrics.stage("recommend1"):
+        do_recommend(1, delta["users"])
+    Config.industry_weight, Config.position_weight = 0.3, 0.7
+    with metrics.stage("recommend2"):
+        do_recommend(2, delta["users"])
+    with metrics.stage("padding"):
+        padding_result()
+    return True
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    first_cluster()
-    second_cluster(1)
-    do_recommend(1)
-    Config.industry_weight, Config.position_weight = 0.3, 0.7
-    second_cluster(2)
-    do_recommend(2)
-    padding_result()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true",
+                        help="只处理日志中新增的记录，沿用上次的聚类结果")
+    parser.add_argument("--force", action="store_true",
+                        help="忽略步骤缓存，重新运行所有步骤")
+    parser.add_argument("--profile", metavar="STAGE",
+                        help="用 cProfile 分析一个步骤，如 recommend1 或 cluster1/get_user_position")
+    args = parser.parse_args()
+    if args.force:
+        Config.stage_cache = False
+    if args.profile:
+        Config.profile_stage = args.profile
+
+    try:
+        if not (args.incremental and incremental()):
+            pipeline()
+    finally:
+        metrics.dump()
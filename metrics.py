@@ -0,0 +1,125 @@
+# -*- "coding: utf-8" -*-
+
+import cProfile
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import resource  # Windows 上没有该模块，此时不统计内存峰值
+except ImportError:
+    resource = None
+
+from config import Config
+
+_records = []  # 已结束的步骤，按结束顺序
+_stack = []  # 进行中的步骤，支持嵌套
+
+
+def _peak_rss_mb():
+    """
+    本进程（以及已结束的子进程）到目前为止的内存峰值，单位MB
+    """
+
+    if resource is None:
+        return None
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / 1024, 1)  # Linux 上 ru_maxrss 的单位为KB
+
+
+def _current_rss_mb():
+    """
+    本进程当前的内存占用，单位MB；只在有 /proc 的系统（Linux）上可用，否则为 None
+    """
+
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024, 1)
+
+
+@contextmanager
+def stage(name, **counts):
+    """
+    统计一个步骤的耗时、CPU时间和内存；嵌套的步骤名以 / 连接，如 recommend1/convert_recommendation
+
+    内存峰值是进程启动以来的最高值，因此同时记录步骤开始、结束时的内存占用（rss_start_mb、rss_end_mb），
+    以及这一步骤是否抬高了内存峰值（raised_peak）：为 True 时 peak_rss_mb 即为该步骤中的峰值
+
+    Config.profile_stage 与步骤名（完整名或最后一段）相同时，用 cProfile 分析该步骤，
+    结果保存在 ./temp/profile_<步骤名>.prof，可用 python -m pstats 查看
+    """
+
+    record = {"stage": "/".join([item["stage"] for item in _stack[-1:]] + [name]), "counts": dict(counts)}
+    profiler = None
+    if Config.profile_stage in (name, record["stage"]):
+        profiler = cProfile.Profile()
+    _stack.append(record)
+    record["rss_start_mb"] = _current_rss_mb()
+    peak_before = _peak_rss_mb()
+    wall, cpu = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profile_path = "./temp/profile_{}.prof".format(record["stage"].replace("/", "_"))
+            profiler.dump_stats(profile_path)
+            logging.info("profile of {} saved to {}".format(record["stage"], profile_path))
+        record["wall_seconds"] = round(time.perf_counter() - wall, 3)
+        record["cpu_seconds"] = round(time.process_time() - cpu, 3)
+        record["rss_end_mb"] = _current_rss_mb()
+        record["peak_rss_mb"] = _peak_rss_mb()
+        record["raised_peak"] = None if peak_before is None else record["peak_rss_mb"] > peak_before
+        _stack.pop()
+        _records.append(record)
+
+
+def count(**counts):
+    """
+    为当前步骤记录数量，如 count(rows=..., users=...)；不在任何步骤中时忽略
+    """
+
+    if _stack:
+        _stack[-1]["counts"].update(counts)
+
+
+def append(key, item):
+    """
+    为当前步骤追加一条明细，如每一簇的耗时；不在任何步骤中时忽略
+    """
+
+    if _stack:
+        _stack[-1].setdefault(key, []).append(item)
+
+
+def skip(name):
+    """
+    记录一个因输入未变化而跳过的步骤
+    """
+
+    _records.append({"stage": name, "skipped": True})
+
+
+def records():
+    return list(_records)
+
+
+def dump(path=None):
+    """
+    将所有步骤的统计结果写入 JSON 文件（默认为 Config.metrics_path）
+    """
+
+    path = path or Config.metrics_path
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"time": time.strftime("%Y-%m-%d %H:%M:%S"), "pid": os.getpid(), "stages": _records},
+                  f, ensure_ascii=False, indent=2)
+    logging.info("metrics saved to {}".format(path))
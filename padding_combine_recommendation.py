@@ -1,23 +1,68 @@
 # -*- "coding: utf-8" -*-
 
-from collections import Counter, defaultdict
+import csv
 import logging
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+try:
+    import pyarrow  # 保存 Feather/Parquet 格式的推荐结果需要 pyarrow，没有安装时只保存CSV
+except ImportError:
+    pyarrow = None
 
 from config import Config
+from cluster_by_industry_position import load_province, user_industries
+from interaction_store import VIEW, load_store
+import metrics
 
 def get_all_users():
     """
-    找出所有用户名，便于后续对没有推荐结果的用户做补齐
+    找出所有用户名及其等级，便于后续对没有推荐结果的用户做补齐
+
+    Returns:
+        DataFrame  username, category 两列
+    """
+
+    return pd.read_csv("./temp/username-category-clv_table.csv", usecols=["username", "category"], dtype=str,
+                       keep_default_na=False, encoding="utf-8-sig")
+
+
+def _top_laws(rows, law_id, n_rows, n_laws):
+    """
+    在一次计数中统计每一行（分群）中各法律法规的阅读量，每行取阅读量最高的 Config.n_recommendation 项，
+    阅读量相同时按首次出现的顺序
+
+    Returns:
+        ndarray(n_rows, n_recommendation)  法律法规编号，不足的为 -1
+    """
+
+    counts = sparse.csr_matrix((np.ones(law_id.shape[0], dtype=np.int64), (rows, law_id)), shape=(n_rows, n_laws))
+    counts.sum_duplicates()
+    top = np.full((n_rows, Config.n_recommendation), -1, dtype=np.int64)
+    for row in range(n_rows):
+        start, end = counts.indptr[row], counts.indptr[row+1]
+        order = np.argsort(-counts.data[start:end], kind="stable")[:Config.n_recommendation]
+        top[row, :order.shape[0]] = counts.indices[start:end][order]
+    return top
+
+
+def _view_records(store):
+    """
+    参与统计阅读量的记录：浏览记录，且不是无效的法律法规id
     """
 
-    users = []
-    with open("./temp/username-category-clv_table.csv", "r", encoding="utf-8-sig") as f:
-        f.readline()
-        for line in f:
-            segments = line.strip().split(",")
-            username = segments[0]
-            users.append(username)
-    return users
+    return np.nonzero((store["source"] == VIEW) & (store["laws"] != "undefined")[store["law_id"]])[0]
+
+
+def _law_names(store):
+    return pd.Series(store["law_names"], dtype=object).str.replace(",", "，").values  # 与 convert_recommendation 一致
+
+
+def _law_nums(store):
+    return pd.Series(store["law_nums"], dtype=object).str.replace(",", "，").values  # 与 convert_recommendation 一致
 
 
 def get_popular_laws():
@@ -25,73 +70,200 @@ def get_popular_laws():
     找出阅读量高的记录作为热门法律法规，用于第三类群体的推荐，以及前两类用户无推荐或推荐数量不足的补齐
     """
     
-    laws = []
-    with open(Config.view_records_path, "r", encoding="utf-8") as f:
-        columns = [item.replace('"',"") for item in f.readline().strip().split('","')]
-        law_index = columns.index("lawId")
-        name_index = columns.index("nameCN")
-        num_index = columns.index("documentNum")
-        for line in f:
-            segments = line.strip().split('","')
-            law = segments[law_index].replace('"',"")
-            name = segments[name_index].replace('"',"")
-            num = segments[num_index].replace('"',"")
-            laws.append((law,name,num))
-    law_counter = sorted(dict(Counter(laws)).items(), key=lambda x:x[1], reverse=True)
-    popular_laws = [item[0] for item in law_counter[:Config.n_recommendation]]
+    store = load_store()
+    records = _view_records(store)
+    order = _top_laws(np.zeros(records.shape[0], dtype=np.int64), store["law_id"][records], 1, store["laws"].shape[0])[0]
+    order = order[order >= 0]
+    popular_laws = list(zip(store["laws"][order].tolist(), _law_names(store)[order].tolist(), _law_nums(store)[order].tolist()))
     return popular_laws
 
 
+def _segment_of(users, kind):
+    """
+    一种分群下每个用户所在的分群
+
+    Returns:
+        Series  用户名 -> 分群名，没有该分群数据的用户不在其中
+    """
+
+    if kind == "industry":  # 浏览次数最多的适用行业
+        store = load_store()
+        most_common_users, most_common_industries, _ = user_industries(store)
+        return pd.Series(store["industries"][most_common_industries], index=store["users"][most_common_users])
+    if kind == "province":  # 最后一次登录的省份，二类群体聚类时已保存，不再读取登录数据
+        return load_province()
+    if kind == "category":  # 高级、中级、初级用户
+        return users.drop_duplicates(subset="username").set_index("username")["category"]
+    raise ValueError("Invalid popular segment: {}, should in (industry, province, category)".format(kind))
+
+
+def build_popularity_index(users):
+    """
+    热门法律法规索引：全局热门，以及 Config.popular_segments 中每种分群（行业、省份、等级）下每个分群的热门
+
+    所有分群的阅读量在同一次计数中统计；分群的热门不足 n_recommendation 项时，依次用全局热门中未包含的补足
+
+    Args:
+        users: DataFrame  get_all_users 的结果
+    Returns:
+        lists: ndarray(分群数+1, n_recommendation)  第0行为全局热门，其余每行为一个分群的热门，均为法律法规编号
+        user_rows: ndarray  users 中每个用户补齐时使用 lists 的哪一行：依次取 Config.popular_segments 中
+                            用户所在且有阅读记录的分群，都没有时为全局热门
+    """
+
+    store = load_store()
+    records = _view_records(store)
+    record_users = store["user_id"][records]
+    record_laws = store["law_id"][records]
+    store_users = pd.Series(store["users"], dtype=object)
+
+    # 第0行为全局，每种分群的各个分群依次排在后面
+    rows = [np.zeros(records.shape[0], dtype=np.int64)]
+    laws = [record_laws]
+    user_segments = []
+    n_rows = 1
+    for kind in Config.popular_segments:
+        segment_of = _segment_of(users, kind)
+        segments = pd.Index(segment_of.unique())
+        # 每个用户编号只查一次所在的分群，再按记录的用户编号取出
+        record_segment = segments.get_indexer(store_users.map(segment_of))[record_users]
+        rows.append(n_rows + record_segment[record_segment >= 0])
+        laws.append(record_laws[record_segment >= 0])
+        user_segment = segments.get_indexer(users["username"].map(segment_of))
+        user_segments.append(np.where(user_segment >= 0, n_rows + user_segment, -1))
+        metrics.count(**{"{}_segments".format(kind): len(segments)})
+        n_rows += len(segments)
+    top = _top_laws(np.concatenate(rows), np.concatenate(laws), n_rows, store["laws"].shape[0])
+
+    # 用全局热门补足各分群的热门
+    popular = top[0][top[0] >= 0]
+    lists = np.full(top.shape, -1, dtype=np.int64)
+    for row in range(n_rows):
+        laws = top[row][top[row] >= 0]
+        laws = np.concatenate([laws, popular[~np.isin(popular, laws)]])[:top.shape[1]]
+        lists[row, :laws.shape[0]] = laws
+
+    user_rows = np.zeros(users.shape[0], dtype=np.int64)
+    for user_segment in reversed(user_segments):  # 优先级高的分群后写，覆盖优先级低的
+        valid = user_segment >= 0
+        valid[valid] = top[user_segment[valid], 0] >= 0
+        user_rows[valid] = user_segment[valid]
+    return lists, user_rows
+
+
+RESULT_COLUMNS = ["序号", "用户名", "推荐文件中文名", "推荐文件id", "推荐文件标准号", "相关度"]
+
+
+def _read_recommendation(path):
+    """
+    读取 convert_recommendation 的结果，所有列均为字符串；中文名、标准号中的逗号已替换，按逗号切分即可
+    """
+
+    return pd.read_csv(path, header=0, names=RESULT_COLUMNS[1:], dtype=str, keep_default_na=False,
+                       quoting=csv.QUOTE_NONE, index_col=False, encoding="utf-8-sig")  # 不把第一列当作索引
+
+
 def combine():
     """
     合并前两类群体的推荐结果
+
+    Returns:
+        DataFrame  除序号外的各列，均为字符串
+    """
+
+    return pd.concat([_read_recommendation("./temp/recommendation_cn1.csv"),
+                      _read_recommendation("./temp/recommendation_cn2.csv")], ignore_index=True)
+
+
+def padding(usernames, combined, lists, user_rows):
     """
+    生成第三类群体的推荐结果，同时补齐前两类群体中无推荐或推荐数量不足的情况
 
-    success_users = defaultdict(int)
-    cnt = 1
-    with open(Config.result_path, "w", encoding="utf-8-sig") as fout:
-        with open("./temp/recommendation_cn1.csv", "r", encoding="utf-8-sig") as f1:
-            fout.write("序号,用户名,推荐文件中文名,推荐文件id,推荐文件标准号,相关度\n")
-            f1.readline()
-            for line in f1:
-                username = line.strip().split(",")[0]
-                success_users[username] += 1
-                fout.write(str(cnt)+","+line)
-                cnt += 1
-        with open("./temp/recommendation_cn2.csv", "r", encoding="utf-8-sig") as f2:
-            f2.readline()
-            for line in f2:
-                username = line.strip().split(",")[0]
-                success_users[username] += 1
-                fout.write(str(cnt)+","+line)
-                cnt += 1
-    return success_users, cnt
-
-
-def padding(users, success_users, popular_laws, cnt):
-    """
-    追加第三类群体的推荐结果，同时补齐前两类群体中无推荐或推荐数量不足的情况
-    """
-
-    with open(Config.result_path, "a", encoding="utf-8-sig") as fout:
-        for user in users:
-            if user not in success_users:  # 单独为一类的用户 以及 第三类用户 直接推荐热门数据
-                for law in popular_laws:
-                    fout.write("{},{},{},{},{},{}\n".format(cnt, user, *law, 0))
-                    cnt += 1
-            elif success_users[user] < Config.n_recommendation:
-                for index in range(Config.n_recommendation-success_users[user]):
-                    law = popular_laws[index]
-                    fout.write("{},{},{},{},{},{}\n".format(cnt, user, *law, 0))
-                    cnt += 1
+    每个用户从 build_popularity_index 为其选定的热门列表中，补齐 n_recommendation 减去已有推荐数
+    （不少于0、不多于全局热门数）项，无推荐的用户即为整个热门列表
+
+    Returns:
+        DataFrame  补齐的推荐结果，列与 combine 的结果相同
+    """
+
+    store = load_store()
+    usernames = np.asarray(usernames, dtype=object)
+    success_counts = combined["用户名"].value_counts()
+    counts = success_counts.reindex(usernames, fill_value=0).values
+    n_padding = np.clip(Config.n_recommendation - counts, 0, (lists[0] >= 0).sum())
+
+    # 第 i 个用户补齐其热门列表中的前 n_padding[i] 项
+    starts = np.cumsum(n_padding) - n_padding
+    law_index = np.arange(n_padding.sum()) - np.repeat(starts, n_padding)
+    law_codes = lists[np.repeat(user_rows, n_padding), law_index]
+    return pd.DataFrame({
+            "用户名": np.repeat(usernames, n_padding),
+            "推荐文件中文名": _law_names(store)[law_codes],
+            "推荐文件id": store["laws"][law_codes].astype(object),
+            "推荐文件标准号": _law_nums(store)[law_codes],
+            "相关度": "0",
+        }, columns=RESULT_COLUMNS[1:])
+
+
+def result_paths():
+    """
+    run 生成的推荐结果文件：Config.result_table_path（Feather 或 Parquet，需要 pyarrow），
+    以及 Config.export_csv 为 True 或没有安装 pyarrow 时的 Config.result_path
+    """
+
+    paths = []
+    if pyarrow is not None:
+        paths.append(Config.result_table_path)
+    if Config.export_csv or pyarrow is None:
+        paths.append(Config.result_path)
+    return paths
+
+
+def save_result(result):
+    """
+    保存推荐结果；先写临时文件，完成后再替换，读取推荐结果的程序不会读到写了一半的文件
+    """
+
+    if pyarrow is not None:
+        table = result.assign(相关度=result["相关度"].astype(np.float64))
+        temp_path = Config.result_table_path + ".tmp"
+        if Config.result_table_path.endswith(".parquet"):
+            table.to_parquet(temp_path, index=False)
+        else:
+            table.to_feather(temp_path)
+        os.replace(temp_path, Config.result_table_path)
+    else:
+        logging.warning("pyarrow is not installed, only save {}".format(Config.result_path))
+
+    if Config.result_path in result_paths():
+        temp_path = Config.result_path + ".tmp"
+        lines = result["序号"].astype(str)
+        for column in RESULT_COLUMNS[1:]:
+            lines = lines + "," + result[column]
+        with open(temp_path, "w", encoding="utf-8-sig") as f:
+            f.write(",".join(RESULT_COLUMNS) + "\n")
+            if result.shape[0]:
+                f.write("\n".join(lines.tolist()) + "\n")
+        os.replace(temp_path, Config.result_path)
 
 
 def run():
     logging.info("padding and combine result...")
     users = get_all_users()
     popular_laws = get_popular_laws()
-    success_users, cnt = combine()
-    padding(users, success_users, popular_laws, cnt)
+    # 供在线服务对没有推荐结果的用户补齐；同样先写临时文件再替换，在线服务重新加载时不会读到写了一半的文件
+    with open(Config.popular_laws_path + ".tmp", "w", encoding="utf-8-sig") as f:
+        f.write("推荐文件id,推荐文件中文名,推荐文件标准号\n")
+        for law in popular_laws:
+            f.write("{},{},{}\n".format(*law))
+    os.replace(Config.popular_laws_path + ".tmp", Config.popular_laws_path)
+
+    combined = combine()
+    metrics.count(users=users.shape[0], recommended_users=combined["用户名"].nunique(), combined_rows=combined.shape[0])
+    lists, user_rows = build_popularity_index(users)
+    result = pd.concat([combined, padding(users["username"].values, combined, lists, user_rows)], ignore_index=True)
+    result.insert(0, "序号", np.arange(1, result.shape[0]+1))
+    save_result(result)
 
 
 if __name__ == "__main__":
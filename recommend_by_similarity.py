@@ -1,14 +1,22 @@
 # -*- "coding: utf-8" -*-
 
-from collections import defaultdict
+import codecs
+import hashlib
+import io
 import logging
+import multiprocessing
 import pickle
 import os
+import shutil
+import time
 
 import numpy as np
 import pandas as pd
+from scipy import sparse
 
 from config import Config
+import metrics
+from interaction_store import load_store, user_ids, valid_records
 
 
 def load_view_records(user_list=None):
@@ -18,262 +26,638 @@ def load_view_records(user_list=None):
     如：
     """
 
-    users = set()
-    laws = set()
-
     ##########
     # 找出浏览记录和下载记录所涉及的所有用户和法律法规，便于构建用户的偏好矩阵
     ##########
 
     # logging.info("filter and save all users and laws...")
-    with open(Config.view_records_path, "r", encoding="utf-8") as f:
-        columns = [item.replace('"',"") for item in f.readline().strip().split('","')]
-        username_index = columns.index("username")
-        law_id_index = columns.index("lawId")
-        for line in f:
-            segments = line.strip().split('","')
-            username = segments[username_index].replace('"',"")
-            if user_list != None and username not in user_list:
-                continue
-            law_id = segments[law_id_index].replace('"',"")
-            if law_id == "undefined":
-                continue
-            if username != "":
-                users.add(username)
-                laws.add(law_id)
-
-    with open(Config.download_records_path, "r", encoding="utf-8") as f:
-        columns = [item.replace('"',"") for item in f.readline().strip().split('","')]
-        username_index = columns.index("username")
-        law_id_index = columns.index("lawId")
-        for line in f:
-            segments = line.strip().split('","')
-            username = segments[username_index].replace('"',"")
-            if user_list != None and username not in user_list:
-                continue
-            law_id = segments[law_id_index].replace('"',"")
-            if law_id == "undefined":
-                continue
-            if username != "":
-                users.add(username)
-                laws.add(law_id)
-
-    users2id = {item:idx for idx, item in enumerate(users)}
-    laws2id = {item:idx for idx, item in enumerate(laws)}
-
-    with open("./temp/users2id.pkl", "wb") as f:
-        pickle.dump(users2id, f, -1)
-    with open("./temp/laws2id.pkl", "wb") as f:
-        pickle.dump(laws2id, f, -1)
-
+    store = load_store()
+    mask = valid_records(store)
+    if user_list is not None:
+        mask &= np.isin(store["user_id"], user_ids(store, user_list))
+    user_id = store["user_id"][mask]
+    law_id = store["law_id"][mask]
+    weight = store["weight"][mask]
+
+    user_idx, rows = np.unique(user_id, return_inverse=True)
+    law_idx, cols = np.unique(law_id, return_inverse=True)
+    users = tuple(store["users"][user_idx].tolist())
+    laws = tuple(store["laws"][law_idx].tolist())
 
     ##########
-    # 构建并保存用户的偏好矩阵
+    # 构建用户的偏好矩阵
     ##########
     # logging.info("generate and save user-law score matrix...")
-    users = tuple(users)  # set类型无序，转为tuple类型固定次序
-    laws = tuple(laws)
     n_user = len(users)
     n_law = len(laws)
-    user_law_mat = np.zeros((n_user, n_law), dtype=np.float32)  # 偏好矩阵，评分初始化为0，使用float32以上类型加快矩阵运算
-
-    with open(Config.view_records_path, "r", encoding="utf-8") as f:
-        columns = [item.replace('"',"") for item in f.readline().strip().split('","')]
-        username_index = columns.index("username")
-        law_id_index = columns.index("lawId")
-        for line in f:
-            segments = line.strip().split('","')
-            username = segments[username_index].replace('"',"")
-            if user_list != None and username not in user_list:
-                continue
-            law_id = segments[law_id_index].replace('"',"")
-            if law_id == "undefined":
-                continue
-            if username != "":
-                user_law_mat[users2id[username]][laws2id[law_id]] += Config.view_weight * 1
-
-    with open(Config.download_records_path, "r", encoding="utf-8") as f:
-        columns = [item.replace('"',"") for item in f.readline().strip().split('","')]
-        username_index = columns.index("username")
-        law_id_index = columns.index("lawId")
-        for line in f:
-            segments = line.strip().split('","')
-            username = segments[username_index].replace('"',"")
-            if user_list != None and username not in user_list:
-                continue
-            law_id = segments[law_id_index].replace('"',"")
-            if law_id == "undefined":
-                continue
-            if username != "":
-                user_law_mat[users2id[username]][laws2id[law_id]] += Config.download_weight * 1
-
-    with open("./temp/user_law_mat.pkl", "wb") as f:  # 保存用户的偏好矩阵，将在推荐法律法规时用到
-        pickle.dump(user_law_mat, f, -1)
+    # 偏好矩阵绝大部分为0，使用CSR稀疏矩阵存储，同一用户对同一法律法规的多条记录分值在转换时累加
+    user_law_mat = sparse.coo_matrix((weight, (rows, cols)), shape=(n_user, n_law), dtype=np.float32).tocsr()
+    user_law_mat.sum_duplicates()  # 保证每行的列号有序
 
     return user_law_mat, users, laws
 
 
+def load_user_law_matrix():
+    """
+    构建全体用户的偏好矩阵，只需构建一次，每一簇的偏好矩阵通过 slice_user_law_matrix 按行截取
+
+    矩阵保存在 Config.matrix_path，存储增量更新后只需将新增的记录累加到已保存的矩阵上；
+    存储重新全量构建后（generation 变化）才重新构建整个矩阵
+
+    Returns:
+        user_law_mat: CSR稀疏矩阵  行为存储中的全体用户，列为存储中的全体法律法规
+        users: tuple  行号对应的用户名
+        laws: tuple  列号对应的法律法规id
+    """
+
+    store = load_store()
+    n_records = store["user_id"].shape[0]
+    shape = (store["users"].shape[0], store["laws"].shape[0])
+
+    user_law_mat, start = None, 0
+    if os.path.exists(Config.matrix_path):
+        with np.load(Config.matrix_path) as saved:
+            if int(saved["generation"]) == int(store["generation"]) and int(saved["n_records"]) <= n_records:
+                user_law_mat = sparse.csr_matrix(
+                        (saved["data"], saved["indices"], saved["indptr"]), shape=tuple(saved["shape"]))
+                start = int(saved["n_records"])
+
+    if user_law_mat is None or start < n_records:
+        mask = valid_records(store)[start:]
+        delta_mat = sparse.coo_matrix(
+                (store["weight"][start:][mask], (store["user_id"][start:][mask], store["law_id"][start:][mask])),
+                shape=shape, dtype=np.float32
+            ).tocsr()
+        if user_law_mat is None:
+            user_law_mat = delta_mat
+        else:  # 新用户、新法律法规的编号排在已有编号之后，扩大矩阵后直接累加
+            user_law_mat.resize(shape)
+            user_law_mat = (user_law_mat + delta_mat).tocsr()
+        user_law_mat.sum_duplicates()  # 保证每行的列号有序
+
+        # 先写临时文件再替换，多个进程同时更新时不会读到写了一半的文件
+        temp_path = "{}.{}.npz".format(Config.matrix_path, os.getpid())
+        np.savez(temp_path, data=user_law_mat.data, indices=user_law_mat.indices, indptr=user_law_mat.indptr,
+                 shape=np.array(shape), generation=store["generation"], n_records=np.int64(n_records))
+        os.replace(temp_path, Config.matrix_path)
+    return user_law_mat, tuple(store["users"].tolist()), tuple(store["laws"].tolist())
+
+
+def cluster_rows(user_law_mat, users, user_index, user_list):
+    """
+    一簇用户在全体用户的偏好矩阵中的行号，以及对应的用户名
+
+    与 load_view_records(user_list) 的结果一致：只保留有浏览或下载记录的用户，且按用户编号排序
+    """
+
+    rows = np.unique(np.array([user_index[username] for username in user_list if username in user_index], dtype=np.int64))
+    rows = rows[np.diff(user_law_mat.indptr)[rows] > 0]  # 去掉没有记录的用户
+    return rows, tuple(users[row] for row in rows)
+
+
+def slice_user_law_matrix(user_law_mat, users, user_index, user_list):
+    """
+    从全体用户的偏好矩阵中截取一簇用户的偏好矩阵，耗时只与簇的大小有关
+
+    列仍为全体法律法规，没有记录的列不影响相似度和推荐结果
+    """
+
+    rows, users = cluster_rows(user_law_mat, users, user_index, user_list)
+    return user_law_mat[rows], users
+
+
+def _row_norm(X):
+    """
+    计算每一行的范数，支持 ndarray 和稀疏矩阵
+    """
+
+    if sparse.issparse(X):
+        return np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    return np.linalg.norm(X, axis=1)
+
+
 def _cal_cosine(X, Y):
     '''
     计算余弦相似度，X 为左矩阵，Y 为右矩阵
     Args:
-        X: ndarray  行数m表示有m个元素，列数n表示每个元素用n个特征表示
-        Y: ndarray  行数m表示有m个元素，列数n表示每个元素用n个特征表示
+        X: ndarray 或 稀疏矩阵  行数m表示有m个元素，列数n表示每个元素用n个特征表示
+        Y: ndarray 或 稀疏矩阵  行数m表示有m个元素，列数n表示每个元素用n个特征表示
     Returns:
         cosine: ndarray 第i行第j列的值是第i个元素和第j个元素之间的相似度
     '''
     numerator = X.dot(Y.T)  # 向量 a 乘以向量 b (分子)
-    norm_X = np.linalg.norm(X, axis=1)  # 每行一个范数，结果为一维 ndarray 数据
-    norm_Y = np.linalg.norm(Y, axis=1)  # 每行一个范数，结果为一维 ndarray 数据
+    if sparse.issparse(numerator):  # 分块计算，每块的结果转为 ndarray 不会占用过多内存
+        numerator = numerator.toarray()
+    norm_X = _row_norm(X)  # 每行一个范数，结果为一维 ndarray 数据
+    norm_Y = _row_norm(Y)  # 每行一个范数，结果为一维 ndarray 数据
     # 为防止零作除数做的处理
     cosine = numerator /np.maximum(np.expand_dims(norm_X, axis=1),10e-20) /np.maximum(np.expand_dims(norm_Y, axis=0),10e-20)
     return cosine
 
 
+def _top_k(similarity, k):
+    """
+    每一行只选出相似度最高的k个，再对这k个排序，避免对整行排序
+
+    Returns:
+        indices: ndarray  选出的列号，同一行按相似度降序
+        scores: ndarray  对应的相似度
+    """
+
+    indices = np.argpartition(-similarity, k-1, axis=1)[:, :k]
+    scores = np.take_along_axis(similarity, indices, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+def _streamed_top_k(X, Y, k):
+    """
+    Y 也按 Config.step 行分块，逐块与 X 计算相似度，并与之前各块选出的邻居合并后重新选出k个，
+    内存占用只与 Config.step 和 k 有关，与 Y 的行数无关
+    """
+
+    indices = np.zeros((X.shape[0], 0), dtype=np.int64)
+    scores = np.zeros((X.shape[0], 0))
+    for start in range(0, Y.shape[0], Config.step):
+        similarity = _cal_cosine(X, Y[start:start+Config.step])
+        columns = np.broadcast_to(np.arange(start, start+similarity.shape[1]), similarity.shape)
+        candidates = np.hstack([indices, columns])
+        selected, scores = _top_k(np.hstack([scores, similarity]), min(k, candidates.shape[1]))
+        indices = np.take_along_axis(candidates, selected, axis=1)
+    return indices, scores
+
+
+def _memmap_dir():
+    """
+    本进程的内存映射文件所在目录
+    """
+
+    path = os.path.join(Config.memmap_dir, str(os.getpid()))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _open_memmap(path, dtype):
+    """
+    以只读的内存映射方式打开二进制文件，空文件无法映射，返回空数组
+    """
+
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+def memmap_csr(name, mat, rows=None, transform=None):
+    """
+    将CSR稀疏矩阵按 Config.step 行一块写入 Config.memmap_dir，返回以内存映射方式读取的同一矩阵，
+    按行截取时只读取用到的部分；写入时内存中只有一块
+
+    Args:
+        name: str  文件名前缀
+        mat: CSR稀疏矩阵  可以是以内存映射方式读取的矩阵
+        rows: ndarray  只写入这些行（按此顺序），为 None 时写入所有行
+        transform: 写入前对每一块的处理，输入输出均为CSR稀疏矩阵，行数不变
+    """
+
+    n_rows = mat.shape[0] if rows is None else rows.shape[0]
+    # 行号、列号的类型与 scipy 选择的一致，创建矩阵时不会再复制一份
+    index_dtype = np.int32 if max(mat.nnz, mat.shape[1]) < np.iinfo(np.int32).max else np.int64
+    data_path, indices_path = (os.path.join(_memmap_dir(), "{}_{}.bin".format(name, part)) for part in ("data", "indices"))
+    indptr = np.zeros(n_rows+1, dtype=index_dtype)
+    dtype = mat.dtype
+    with open(data_path, "wb") as fdata, open(indices_path, "wb") as findices:
+        for pointer in range(0, n_rows, Config.step):
+            block = mat[pointer:pointer+Config.step] if rows is None else mat[rows[pointer:pointer+Config.step]]
+            if transform is not None:
+                block = transform(block)
+            dtype = block.dtype
+            fdata.write(block.data.tobytes())
+            findices.write(block.indices.astype(index_dtype).tobytes())
+            indptr[pointer+1:pointer+1+block.shape[0]] = indptr[pointer] + block.indptr[1:]
+    arrays = (_open_memmap(data_path, dtype), _open_memmap(indices_path, index_dtype), indptr)
+    return sparse.csr_matrix(arrays, shape=(n_rows, mat.shape[1]), copy=False)
+
+
+def _candidate_block(block):
+    """
+    用户没有记录的法律法规，difference>1 等价于 邻居分值>1，只需保留分值>1的项
+    """
+
+    candidate = sparse.csr_matrix((np.where(block.data > 1, block.data, 0), block.indices, block.indptr), shape=block.shape)
+    candidate.eliminate_zeros()
+    return candidate
+
+
 def find_neighbors(X, Y):
     '''
-    组织数据分块计算相似度
+    组织数据分块计算相似度，每个元素只保留相似度最高的 Config.n_neighbors 个邻居
+
+    Config.out_of_core 为 True 时，Y 也分块计算，邻居列表边计算边写入 Config.memmap_dir 中的文件，
+    返回以内存映射方式读取的数组，簇再大内存占用也只与 Config.step 有关
     Args:
-        X: ndarray  行数m表示有m个元素，列数n表示每个元素用n个特征表示
-        Y: ndarray  行数m表示有m个元素，列数n表示每个元素用n个特征表示
+        X: ndarray 或 CSR稀疏矩阵  行数m表示有m个元素，列数n表示每个元素用n个特征表示
+        Y: ndarray 或 CSR稀疏矩阵  行数m表示有m个元素，列数n表示每个元素用n个特征表示
     Returns:
-        similarities: ndarray 第i行第j列的值是第i个元素和第j个元素之间的相似度
+        users: ndarray(int32)  X 中元素的行号，按行号升序
+        neighbors: ndarray(int32)  邻居在 Y 中的行号，同一元素的邻居按相似度降序
+        similarities: ndarray(float32)  元素与邻居之间的相似度，只保留大于0的
     '''
 
-    f = open("./temp/user_neighbors.csv", "w", encoding="utf-8-sig")
+    users, neighbors, similarities = [], [], []
+    if Config.out_of_core:
+        paths = [os.path.join(_memmap_dir(), name) for name in ("users.bin", "neighbors.bin", "similarities.bin")]
+        users, neighbors, similarities = [open(path, "wb") for path in paths]
+    k = min(Config.n_neighbors+1, Y.shape[0])  # 包含自身
 
     pointer = 0
     cnt = 0
     total = X.shape[0]//Config.step +1
-    user_index = 0
-    while pointer <= X.shape[0]:
+    while pointer < X.shape[0]:
         cnt += 1
         # logging.info("{}/{}".format(cnt, total))
 
-        similarity = _cal_cosine(X[pointer:pointer+Config.step], Y)
-        pointer += Config.step
-
         ##########
-        # save result
-        # 保存用户的邻居列表，将在推荐法律法规时用到
-        # 每计算一步保存一次，避免持续增加内存占用
+        # 每计算一步只保留选出的邻居，避免持续增加内存占用
         ##########
-        indices = np.argsort(similarity, axis=1)[:, ::-1][:, :Config.n_neighbors+1]  # 包含自身
-        scores = np.sort(similarity, axis=1)[:, ::-1][:, :Config.n_neighbors+1]  # 包含自身
-        for row in range(indices.shape[0]):
-            for col in range(indices.shape[1]):
-                user = user_index
-                neighbor = indices[row, col]
-                score = scores[row, col]
-                if user != neighbor:  # 不考虑自身
-                    if score > 0:  # 只保留相似度大于0的邻居
-                        f.write("{},{},{}\n".format(user,neighbor,score))
-                    else:
-                        break
-            user_index += 1
-    f.close()
-
-
-def recommendation_laws(users, laws, fout):
+        if Config.out_of_core:
+            indices, scores = _streamed_top_k(X[pointer:pointer+Config.step], Y, k)
+        else:
+            indices, scores = _top_k(_cal_cosine(X[pointer:pointer+Config.step], Y), k)
+
+        rows = np.broadcast_to(np.arange(pointer, pointer+indices.shape[0])[:, None], indices.shape)
+        keep = (indices != rows) & (scores > 0)  # 不考虑自身，只保留相似度大于0的邻居
+        for result, values in zip((users, neighbors, similarities),
+                                  (rows[keep].astype(np.int32), indices[keep].astype(np.int32), scores[keep].astype(np.float32))):
+            if Config.out_of_core:
+                result.write(values.tobytes())
+            else:
+                result.append(values)
+        pointer += Config.step
+
+    if Config.out_of_core:
+        for f in (users, neighbors, similarities):
+            f.close()
+        users, neighbors, similarities = (_open_memmap(path, dtype) for path, dtype in zip(paths, (np.int32, np.int32, np.float32)))
+    else:
+        users = np.concatenate(users) if users else np.zeros(0, dtype=np.int32)
+        neighbors = np.concatenate(neighbors) if neighbors else np.zeros(0, dtype=np.int32)
+        similarities = np.concatenate(similarities) if similarities else np.zeros(0, dtype=np.float32)
+
+    if Config.dump_neighbors:  # 调试用：保存用户的邻居列表
+        with open("./temp/user_neighbors.csv", "w", encoding="utf-8-sig") as f:
+            for user, neighbor, score in zip(users, neighbors, similarities):
+                f.write("{},{},{}\n".format(user, neighbor, score))
+
+    return users, neighbors, similarities
+
+
+def _seen_law_scores(user_law_mat, block_mat, neighbor_block, column_max):
     """
-    根据用户的偏好矩阵和用户的邻居列表生成推荐结果，Config中设置了推荐的结果数量
+    计算一批用户对自己已有记录的法律法规的得分
+
+    此时 difference>1 要求 邻居分值 > 当前用户分值+1，与当前用户的分值有关，需要逐项计算；
+    若该列的最大分值都不超过 当前用户分值+1，则不可能有得分，直接跳过
     """
 
-    ##########
-    # 加载用户的偏好矩阵 load_view_records 中生成
-    ##########
-    with open("./temp/user_law_mat.pkl", "rb") as f:
-        user_law_mat = pickle.load(f)
+    rows = np.repeat(np.arange(block_mat.shape[0]), np.diff(block_mat.indptr))
+    laws = block_mat.indices
+    user_scores = block_mat.data
+    possible = column_max[laws] > user_scores + 1
+    rows, laws, user_scores = rows[possible], laws[possible], user_scores[possible]
 
-    ##########
-    # 加载用户的邻居列表 find_neighbors 中生成
-    ##########
-    law_score = defaultdict(float)
-    with open("./temp/user_neighbors.csv", "r", encoding="utf-8-sig") as f:
-        cur_user = None
-        for line in f:
-            user, neighbor, similarity = line.strip().split(",")
-            user, neighbor, similarity = int(user), int(neighbor), float(similarity)
-            # 找出邻居看过或下载过(分值>1)但当前用户没看过也每下载过(分值=0)的法律法规
-            difference = user_law_mat[neighbor] - user_law_mat[user]  # 用 neighbor - user
-            law_indices = np.where(difference>1)[0]  # 筛选结果中分值>1的法律法规即为所求
-            for law_idx in law_indices:
-                # 当前法律法规的得分 = 邻居对该项法律法规的偏好分值 * 当前用户和邻居之间的相似度
-                law_score[law_idx] += user_law_mat[neighbor][law_idx] * similarity
-
-            if cur_user is None:
-                cur_user = user
-            elif user != cur_user:  # 保存上一个用户的推荐结果
-                sorted_law_score = sorted(law_score.items(), key=lambda x:x[1], reverse=True)[:Config.n_recommendation]
-                # # 归一化 score
-                # try:
-                #     max_score = sorted_law_score[0][1]
-                #     min_score = sorted_law_score[-1][1]
-                # except IndexError as e:  # 无推荐结果则跳过（无相似用户 或相似用户的浏览记录中无当前用户未浏览过的文件）
-                #     print(user, users[user], sorted_law_score)
-                # for law, score in sorted_law_score:
-                #     fout.write("{},{},{}\n".format(users[user], laws[law], (score-min_score)/max(max_score-min_score, 1e-5) ))
-                # 不对 score 归一化
-                for law, score in sorted_law_score:
-                    fout.write("{},{},{}\n".format(users[user], laws[law], score))
-                cur_user = user
-                law_score = defaultdict(float)
+    # 将每一项与当前用户的每个邻居配对
+    degree = np.diff(neighbor_block.indptr)[rows]
+    entry = np.repeat(np.arange(rows.shape[0]), degree)
+    offset = np.arange(entry.shape[0]) - np.repeat(np.cumsum(degree) - degree, degree)
+    edge = neighbor_block.indptr[rows][entry] + offset
+    neighbors = neighbor_block.indices[edge]
+    similarities = neighbor_block.data[edge]
+
+    neighbor_scores = np.asarray(user_law_mat[neighbors, laws[entry]]).ravel() if entry.shape[0] else np.zeros(0)
+    hits = neighbor_scores - user_scores[entry] > 1  # 用 neighbor - user
+    law_score = np.bincount(entry[hits], weights=neighbor_scores[hits]*similarities[hits], minlength=rows.shape[0])
+    return sparse.csr_matrix((law_score, (rows, laws)), shape=block_mat.shape)
+
+
+def _top_n(scores, n):
+    """
+    选出每一行得分最高的n项（只保留大于0的），返回 行号、列号、得分，同一行按得分降序
+    """
+
+    scores.sort_indices()
+    lengths = np.diff(scores.indptr)
+    width = max(int(lengths.max()) if lengths.shape[0] else 0, 1)
+    n = min(n, width)
+    rows = np.repeat(np.arange(scores.shape[0]), lengths)
+    cols = np.arange(rows.shape[0]) - scores.indptr[rows]
+
+    # 补齐为等长的二维数组，不足的位置填 -inf
+    padded = np.full((scores.shape[0], width), -np.inf)
+    padded[rows, cols] = scores.data
+    laws = np.full((scores.shape[0], width), -1, dtype=np.int64)
+    laws[rows, cols] = scores.indices
+
+    top = np.argpartition(-padded, n-1, axis=1)[:, :n]
+    top_scores = np.take_along_axis(padded, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+    top_laws = np.take_along_axis(laws, top, axis=1)
+
+    keep = top_scores > 0
+    top_rows = np.broadcast_to(np.arange(scores.shape[0])[:, None], top.shape)
+    return top_rows[keep], top_laws[keep], top_scores[keep]
+
+
+def recommendation_laws(user_law_mat, users, laws, fout, neighbors):
+    """
+    根据用户的偏好矩阵和用户的邻居列表生成推荐结果，Config中设置了推荐的结果数量
+
+    user_law_mat 为 load_view_records 或 slice_user_law_matrix 得到的CSR稀疏矩阵
+    neighbors 为 find_neighbors 的返回结果
+
+    推荐给用户的是邻居看过或下载过、且 邻居分值-用户分值>1 的法律法规，
+    得分 = sum(邻居对该项法律法规的偏好分值 * 当前用户和邻居之间的相似度)；
+    每次对 Config.step 个用户一起计算，每批只需几次稀疏矩阵运算
+    """
+
+    user_ids, neighbor_ids, similarities = neighbors
+    n_user = user_law_mat.shape[0]
+
+    # 用户没有记录的法律法规，difference>1 等价于 邻居分值>1，只需保留分值>1的项
+    if Config.out_of_core:  # 逐块写入内存映射文件，保持 float32，与 float64 的邻居相似度相乘时自动转换
+        candidate_mat = memmap_csr("candidate_mat", user_law_mat, transform=_candidate_block)
+    else:
+        candidate_mat = _candidate_block(user_law_mat.astype(np.float64))
+    # 每一列的最大分值，逐块计算（按列求最大值会将整个矩阵转换为CSC格式）
+    column_max = np.zeros(user_law_mat.shape[1])
+    for pointer in range(0, n_user, Config.step):
+        column_max = np.maximum(column_max, user_law_mat[pointer:pointer+Config.step].max(axis=0).toarray().ravel())
+
+    for pointer in range(0, n_user, Config.step):
+        # 这一批用户的邻居相似度矩阵，第i行第j列为用户pointer+i与邻居j之间的相似度；邻居列表按用户排序，二分查找这一批的范围
+        start, end = np.searchsorted(user_ids, [pointer, pointer+Config.step])
+        neighbor_block = sparse.csr_matrix(
+                (np.asarray(similarities[start:end], dtype=np.float64), (user_ids[start:end] - pointer, neighbor_ids[start:end])),
+                shape=(min(Config.step, n_user-pointer), n_user))
+        block_mat = user_law_mat[pointer:pointer+Config.step]
+
+        scores = neighbor_block.dot(candidate_mat).tocsr()
+        scores = scores - scores.multiply(block_mat != 0)  # 去掉用户已有记录的项，这些项单独计算
+        scores = scores + _seen_law_scores(user_law_mat, block_mat, neighbor_block, column_max)
+        scores.eliminate_zeros()
+
+        # 保存推荐结果，不对 score 归一化
+        rows, cols, values = _top_n(scores.tocsr(), Config.n_recommendation)
+        fout.write("".join("{},{},{}\n".format(users[pointer+row], laws[law], score)
+                           for row, law, score in zip(rows.tolist(), cols.tolist(), values.tolist())))
 
 
 def convert_recommendation(tag):
     """
     对推荐结果稍作转换，增加法律法规的中文名、标准号这两项数据
+
+    法律法规的中文名、标准号按存储中的编号保存一份，推荐结果按 Config.convert_chunk_rows 行一块，
+    整块将法律法规id转换为编号后取出对应的中文名、标准号
     """
 
-    # load all laws
-    cols = ["lawId", "nameCN", "documentNum"]
-    laws = pd.read_csv(Config.view_records_path, encoding="utf-8", usecols=cols)
-    laws.drop_duplicates(inplace=True)
-    laws.fillna('', inplace=True)  # 将NaN都替换为空字符串
-    laws.set_index("lawId", inplace=True)  # 将law id 设为索引
+    # 法律法规id -> 编号 -> 中文名、标准号
+    store = load_store()
+    law_index = pd.Index(store["laws"])
+    law_names = pd.Series(store["law_names"], dtype=object).str.replace(",", "，").values
+    law_nums = pd.Series(store["law_nums"], dtype=object).str.replace(",", "，").values  # 结果中各列以逗号分隔，标准号中的逗号同样替换
 
     # save
-    with open("./temp/user_recommendation.csv", "r", encoding="utf-8-sig") as fin:
-        with open("./temp/recommendation_cn{}.csv".format(tag), "w", encoding="utf-8-sig", buffering=1) as fout:
-            fout.write("用户名,推荐文件中文名,推荐文件id,推荐文件标准号,相关度\n")
-            cnt = 0
-            for line in fin:
-                username, lawid, score = line.strip().split(",")
-                if lawid == "undefined":
-                    continue
-                name_cn = laws.loc[lawid, "nameCN"].replace(",","，")
-                document_num = laws.loc[lawid, "documentNum"]
-                score = round(float(score), 8)
-                cnt += 1
-                print("{}".format(cnt), end="\r")
-                fout.write("{},{},{},{},{}\n".format(username, name_cn, lawid, document_num, score))
-            print("{}".format(cnt))
+    cnt = 0
+    with open("./temp/recommendation_cn{}.csv".format(tag), "w", encoding="utf-8-sig") as fout:
+        fout.write("用户名,推荐文件中文名,推荐文件id,推荐文件标准号,相关度\n")
+        for chunk in pd.read_csv("./temp/user_recommendation{}.csv".format(tag), header=None, names=["username", "lawid", "score"],
+                                 dtype={"username": str, "lawid": str}, keep_default_na=False, encoding="utf-8-sig",
+                                 float_precision="round_trip", chunksize=Config.convert_chunk_rows):
+            chunk = chunk[chunk["lawid"] != "undefined"]
+            if chunk.shape[0] == 0:
+                continue
+            codes = law_index.get_indexer(chunk["lawid"].values)
+            if (codes < 0).any():  # 推荐结果与存储不一致（如推荐之后存储被重新构建），不能取到错误的中文名、标准号
+                raise KeyError("law id not in interaction store: {}".format(chunk["lawid"].values[codes < 0][0]))
+            score = pd.Series([str(round(value, 8)) for value in chunk["score"].tolist()], index=chunk.index)
+            lines = chunk["username"] + "," + law_names[codes] + "," + chunk["lawid"] + "," + law_nums[codes] + "," + score
+            fout.write("\n".join(lines.tolist()) + "\n")
+            cnt += chunk.shape[0]
+            print("{}".format(cnt), end="\r")
+    print("{}".format(cnt))
+
+
+_worker_state = {}  # 每个工作进程的全体用户偏好矩阵和结果分片文件；偏好矩阵由主进程在创建进程池前放入，fork 出的工作进程直接继承
+
+
+def _load_global_state():
+    """
+    Config.global_matrix 为 True 时加载全体用户的偏好矩阵和用户名索引，否则返回 None
+    """
 
+    if not Config.global_matrix:
+        return None
+    all_user_law_mat, all_users, all_laws = load_user_law_matrix()
+    user_index = {username:idx for idx, username in enumerate(all_users)}
+    return all_user_law_mat, all_users, all_laws, user_index
+
+
+def _recommend_cluster(user_list, fout, state):
+    """
+    为一簇用户生成推荐结果并写入 fout，只在同一簇内寻找相似用户
+    """
+
+    if state is not None:
+        all_user_law_mat, all_users, all_laws, user_index = state
+        if Config.out_of_core:  # 偏好矩阵、候选矩阵和邻居列表都通过内存映射文件读取，用完即删除
+            rows, users = cluster_rows(all_user_law_mat, all_users, user_index, user_list)
+            user_law_mat = memmap_csr("user_law_mat", all_user_law_mat, rows)
+        else:
+            user_law_mat, users = slice_user_law_matrix(all_user_law_mat, all_users, user_index, user_list)
+        laws = all_laws
+    else:
+        user_law_mat, users, laws = load_view_records(user_list)
+        if Config.out_of_core:
+            user_law_mat = memmap_csr("user_law_mat", user_law_mat)
+    # logging.info("find neighbors...")
+    neighbors = find_neighbors(user_law_mat, user_law_mat)
+    # logging.info("generate and save recommendations...")
+    recommendation_laws(user_law_mat, users, laws, fout, neighbors)
+    if Config.out_of_core:
+        del user_law_mat, neighbors
+        shutil.rmtree(_memmap_dir())
+
+
+def _init_worker(config):
+    """
+    工作进程初始化：同步主进程中的Config；没有从主进程继承偏好矩阵时（spawn 方式启动）才自行加载
+    """
+
+    for name, value in config.items():
+        setattr(Config, name, value)
+    if "state" not in _worker_state:
+        _worker_state["state"] = _load_global_state()
+
+
+def _recommend_cluster_shard(task):
+    """
+    在工作进程中为一簇用户生成推荐结果，追加到本进程的分片文件中，返回结果在分片中的位置和耗时
+    """
+
+    index, user_list = task
+    start = time.perf_counter()
+    buffer = io.StringIO()
+    _recommend_cluster(user_list, buffer, _worker_state["state"])
+    data = buffer.getvalue().encode("utf-8")
+    if "shard" not in _worker_state:  # 分配到第一簇时才打开本进程的结果分片文件，没有分配到簇的进程不留下空文件
+        _worker_state["shard"] = open("./temp/user_recommendation_shard{}.csv".format(os.getpid()), "wb")
+    shard = _worker_state["shard"]
+    offset = shard.tell()
+    shard.write(data)
+    shard.flush()
+    return index, shard.name, offset, len(data), time.perf_counter() - start
+
+
+def _recommend_parallel(tasks, state):
+    """
+    用进程池并行处理各簇，先调度大的簇以减少长尾；各进程写各自的分片
+
+    Args:
+        tasks: list  (簇的序号, 簇中的用户名列表)
+        state: _load_global_state 的结果，主进程只加载一次，工作进程继承
+    Returns:
+        spans: dict  簇的序号 -> (分片文件, 结果在分片中的起始位置, 长度)，由调用者按簇的原始顺序合并
+    """
+
+    config = {name: value for name, value in vars(Config).items() if not name.startswith("_")}
+    tasks = sorted(tasks, key=lambda task: len(task[1]), reverse=True)
+    sizes = {index: len(user_list) for index, user_list in tasks}
+    spans = {}
+    _worker_state["state"] = state
+    try:
+        with multiprocessing.Pool(min(Config.workers, len(tasks)), initializer=_init_worker, initargs=(config,)) as pool:
+            for cnt, (index, shard, offset, length, seconds) in enumerate(pool.imap_unordered(_recommend_cluster_shard, tasks), 1):
+                print("{}/{}".format(cnt, len(tasks)), end="\r")
+                spans[index] = (shard, offset, length)
+                metrics.append("clusters", {"index": index, "users": sizes[index], "seconds": round(seconds, 4)})
+    finally:
+        _worker_state.pop("state", None)
+    print("{}/{}".format(len(spans), len(tasks)))
+    return spans
+
+
+def _recommend_settings():
+    """
+    影响推荐结果的设置，任一项变化时上次的推荐结果不能复用
+    """
+
+    store = load_store()
+    return (int(store["generation"]), Config.n_neighbors, Config.n_recommendation,
+            Config.view_weight, Config.download_weight)
+
+
+def _load_spans(spans_path, output_path, digest):
+    """
+    读取上次推荐时每一簇的结果在结果文件中的位置；聚类结果或推荐设置变化时返回 None
+    """
+
+    if not os.path.exists(spans_path) or not os.path.exists(output_path):
+        return None
+    with open(spans_path, "rb") as f:
+        previous = pickle.load(f)
+    if previous["digest"] != digest or previous["settings"] != _recommend_settings():
+        return None
+    return previous["spans"]
+
+
+def run(tag, changed_users=None):
+    """
+    为每一簇用户生成推荐结果
+
+    changed_users 为增量更新时有新记录的用户名列表：只重新计算包含这些用户的簇，
+    其余簇直接复用上次的结果（邻居只在同一簇内寻找，其他簇的结果不受影响）；
+    为 None 时重新计算所有簇
+    """
 
-def run(tag):
     logging.info("in recommend_by_similarity.py:")
     logging.info("industry_weight:{}, position_weight:{}".format(Config.industry_weight, Config.position_weight))
 
-    logging.info("recommend for each group of users...")
-    fout = open("./temp/user_recommendation.csv", "w", encoding="utf-8-sig", buffering=1)
-    with open("./temp/userid-userlist_cluster{}.csv".format(tag), "r", encoding="utf-8") as f:
-        cnt = 0
-        # 对于每一簇的用户单独进行推荐，即，只在同一簇内寻找相似用户
-        for line in f:
-            cnt += 1
-            print("{}".format(cnt), end="\r")
-            user_list = eval(",".join(line.strip().split(",")[2:]))
-            if len(user_list) == 1:  # 一个元素单独一类的不寻找相似用户
-                continue
-            user_law_mat, users, laws = load_view_records(user_list)
-            # logging.info("find neighbors...")
-            find_neighbors(user_law_mat, user_law_mat)
-            # logging.info("generate and save recommendations...")
-            recommendation_laws(users, laws, fout)
-            # logging.info("convert recommendation...")
-        print("{}".format(cnt))
-    fout.close()
-    convert_recommendation(tag)
+    # 对于每一簇的用户单独进行推荐，即，只在同一簇内寻找相似用户
+    clusters = []
+    with open("./temp/userid-userlist_cluster{}.csv".format(tag), "rb") as f:
+        cluster_data = f.read()
+    for line in cluster_data.decode("utf-8").splitlines():
+        user_list = eval(",".join(line.strip().split(",")[2:]))
+        if len(user_list) == 1:  # 一个元素单独一类的不寻找相似用户
+            continue
+        clusters.append(user_list)
+
+    output_path = "./temp/user_recommendation{}.csv".format(tag)
+    spans_path = "./temp/user_recommendation{}.spans.pkl".format(tag)
+    digest = hashlib.md5(cluster_data).hexdigest()
+    previous = _load_spans(spans_path, output_path, digest) if changed_users is not None else None
+    if previous is None:
+        todo = set(range(len(clusters)))
+    else:
+        changed_users = set(changed_users)
+        todo = {index for index, user_list in enumerate(clusters) if not changed_users.isdisjoint(user_list)}
+
+    logging.info("recommend for {}/{} groups of users...".format(len(todo), len(clusters)))
+    # 每一簇的结果的来源：上次的结果文件或并行计算的分片文件，其余的在下面串行计算
+    sources = {}
+    if previous is not None:
+        sources.update({index: (output_path,) + previous[index] for index in range(len(clusters)) if index not in todo})
+    state = None
+    if todo:
+        if Config.global_matrix:  # 只构建一次全体用户的偏好矩阵，每一簇按行截取；并行时工作进程继承主进程中的矩阵
+            logging.info("load user-law matrix...")
+        with metrics.stage("load_user_law_matrix"):
+            state = _load_global_state()
+    if Config.workers > 1 and todo:
+        sources.update(_recommend_parallel([(index, clusters[index]) for index in sorted(todo)], state))
+
+    # 按簇的原始顺序合并到临时文件，完成后再替换上次的结果文件
+    spans = []
+    files = {}
+    cnt = 0
+    try:
+        with open(output_path + ".tmp", "wb") as fout:
+            fout.write(codecs.BOM_UTF8)
+            for index, user_list in enumerate(clusters):
+                if index in sources:
+                    path, offset, length = sources[index]
+                    if path not in files:
+                        files[path] = open(path, "rb")
+                    files[path].seek(offset)
+                    data = files[path].read(length)
+                else:
+                    cnt += 1
+                    print("{}".format(cnt), end="\r")
+                    start = time.perf_counter()
+                    buffer = io.StringIO()
+                    _recommend_cluster(user_list, buffer, state)
+                    data = buffer.getvalue().encode("utf-8")
+                    metrics.append("clusters", {"index": index, "users": len(user_list),
+                                                "seconds": round(time.perf_counter() - start, 4)})
+                spans.append((fout.tell(), len(data)))
+                fout.write(data)
+        if cnt:
+            print("{}".format(cnt))
+    finally:
+        for path, f in files.items():
+            f.close()
+            if path != output_path:  # 并行计算的分片文件
+                os.remove(path)
+    os.replace(output_path + ".tmp", output_path)
+    with open(spans_path, "wb") as f:
+        pickle.dump({"digest": digest, "settings": _recommend_settings(), "spans": spans}, f, -1)
+
+    metrics.count(clusters=len(clusters), recomputed_clusters=len(todo),
+                  users=sum(len(user_list) for user_list in clusters), bytes=sum(length for offset, length in spans))
+    # logging.info("convert recommendation...")
+    with metrics.stage("convert_recommendation"):
+        convert_recommendation(tag)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+# -*- "coding: utf-8" -*-
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from config import Config
+
+
+class RecommendationIndex(object):
+    """
+    推荐结果的内存索引，只读
+
+    用户名 -> 用户编号 -> offsets[编号]:offsets[编号+1] 为该用户的推荐在 law_codes、scores 中的位置；
+    法律法规按编号保存一份 id、中文名、标准号，推荐结果中只保存编号
+    """
+
+    def __init__(self, result_path, popular_laws_path):
+        self.signature = _signature(result_path, popular_laws_path)
+
+        law_index = {}
+        self.law_ids, self.law_names, self.law_nums = [], [], []
+
+        def intern_law(lawid, name_cn, document_num):
+            if lawid not in law_index:
+                law_index[lawid] = len(self.law_ids)
+                self.law_ids.append(lawid)
+                self.law_names.append(name_cn)
+                self.law_nums.append(document_num)
+            return law_index[lawid]
+
+        result = _read_result(result_path)
+        user_codes, usernames = pd.factorize(result["用户名"])
+        user_index = {username: code for code, username in enumerate(usernames.tolist())}
+        # 法律法规按首次出现的顺序编号，中文名、标准号取首次出现的一行
+        law_codes, _ = pd.factorize(result["推荐文件id"])
+        first = result.drop_duplicates(subset="推荐文件id")
+        for lawid, name_cn, document_num in zip(first["推荐文件id"].tolist(), first["推荐文件中文名"].tolist(), first["推荐文件标准号"].tolist()):
+            intern_law(lawid, name_cn, document_num)
+        scores = result["相关度"].values
+
+        popular = []
+        with open(popular_laws_path, "r", encoding="utf-8-sig") as f:
+            f.readline()
+            for line in f:
+                segments = line.rstrip("\n").split(",")
+                popular.append(intern_law(segments[0], ",".join(segments[1:-1]), segments[-1]))
+
+        # 合并结果中同一用户的推荐不一定相邻（补齐的在最后），按用户编号稳定排序，保持每个用户的推荐顺序
+        user_codes = np.array(user_codes, dtype=np.int32)
+        order = np.argsort(user_codes, kind="stable")
+        self.user_index = user_index
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(user_codes, minlength=len(user_index)))]).astype(np.int64)
+        self.law_codes = np.array(law_codes, dtype=np.int32)[order]
+        self.scores = np.array(scores, dtype=np.float64)[order]
+        self.popular = np.array(popular, dtype=np.int32)
+        # 热门法律法规的推荐结果对所有没有推荐结果的用户都一样，预先生成
+        self.popular_result = [self._law(code, 0) for code in self.popular.tolist()]
+
+    def _law(self, code, score):
+        return {
+                "lawId": self.law_ids[code],
+                "nameCN": self.law_names[code],
+                "documentNum": self.law_nums[code],
+                "score": score,
+            }
+
+    def lookup(self, username):
+        """
+        查询一个用户的推荐结果；不在推荐结果中的用户返回热门法律法规
+
+        padding 已为上次运行时所有用户（CLV 结果中的用户）按所在分群补齐，这些用户都在推荐结果中，
+        分群热门已包含在其推荐里；不在推荐结果中的是此后才出现的用户，padding 没有为其选定分群，
+        因此返回全局热门（Config.popular_laws_path），与 padding 在用户不属于任何分群时的选择相同
+        """
+
+        code = self.user_index.get(username)
+        if code is None:
+            return {"username": username, "fallback": True, "recommendations": self.popular_result}
+        start, end = self.offsets[code], self.offsets[code+1]
+        recommendations = [self._law(law, score) for law, score in
+                           zip(self.law_codes[start:end].tolist(), self.scores[start:end].tolist())]
+        return {"username": username, "fallback": False, "recommendations": recommendations}
+
+    def lookup_many(self, usernames):
+        return [self.lookup(username) for username in usernames]
+
+
+def _read_result(path):
+    """
+    读取推荐结果：后缀为 .feather 或 .parquet 时直接读取列式存储，否则解析CSV
+    """
+
+    if path.endswith(".feather"):
+        return pd.read_feather(path)
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    rows = []
+    with open(path, "r", encoding="utf-8-sig") as f:
+        f.readline()
+        for line in f:
+            # 从两端取各列，中文名中即使含有逗号也能正确解析
+            segments = line.rstrip("\n").split(",")
+            rows.append((segments[1], ",".join(segments[2:-3]), segments[-3], segments[-2], float(segments[-1])))
+    return pd.DataFrame(rows, columns=["用户名", "推荐文件中文名", "推荐文件id", "推荐文件标准号", "相关度"])
+
+
+def result_path():
+    """
+    在线服务读取的推荐结果：有列式存储时读取列式存储，否则读取CSV
+    """
+
+    return Config.result_table_path if os.path.exists(Config.result_table_path) else Config.result_path
+
+
+def _signature(*paths):
+    """
+    用于判断文件是否被替换：每个文件的 (inode, 大小, 修改时间)
+    """
+
+    signature = []
+    for path in paths:
+        stat = os.stat(path)
+        signature.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+class RecommendationHandler(BaseHTTPRequestHandler):
+    """
+    GET  /recommend?user=A&user=B  查询一个或多个用户的推荐结果
+    POST /recommend  请求体为 {"users": [...]}，批量查询
+    GET  /health  当前索引的用户数和加载时间
+    """
+
+    def _send(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _recommend(self, usernames):
+        index = self.server.index  # 每个请求只读取一次，重新加载时替换引用不影响进行中的请求
+        if len(usernames) == 1:
+            self._send(200, index.lookup(usernames[0]))
+        else:
+            self._send(200, {"results": index.lookup_many(usernames)})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            self._send(200, {"users": len(self.server.index.user_index), "loaded_at": self.server.loaded_at})
+        elif url.path == "/recommend":
+            usernames = parse_qs(url.query).get("user", [])
+            if not usernames:
+                self._send(400, {"error": "missing parameter: user"})
+            else:
+                self._recommend(usernames)
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/recommend":
+            self._send(404, {"error": "not found"})
+            return
+        try:
+            usernames = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))["users"]
+        except (ValueError, KeyError, TypeError):
+            usernames = None
+        if not isinstance(usernames, list) or not all(isinstance(username, str) for username in usernames):
+            self._send(400, {"error": "request body should be {\"users\": [...]}, a list of usernames"})
+            return
+        self._send(200, {"results": self.server.index.lookup_many(usernames)})
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+class RecommendationServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, result_path, popular_laws_path):
+        self.result_path = result_path
+        self.popular_laws_path = popular_laws_path
+        self.load()
+        super().__init__(address, RecommendationHandler)
+
+    def load(self):
+        index = RecommendationIndex(self.result_path, self.popular_laws_path)
+        self.index, self.loaded_at = index, time.strftime("%Y-%m-%d %H:%M:%S")  # 整体替换引用
+        logging.info("loaded {} users, {} recommendations".format(len(index.user_index), index.law_codes.shape[0]))
+
+    def watch(self, interval):
+        """
+        定期检查推荐结果是否被新一次运行替换，是则在后台构建新索引后替换；构建失败时继续使用原索引
+        """
+
+        while True:
+            time.sleep(interval)
+            try:
+                if _signature(self.result_path, self.popular_laws_path) != self.index.signature:
+                    self.load()
+            except Exception:  # 任何错误（如推荐结果缺少某一列）都不能结束重新加载的线程，否则会一直使用旧的推荐结果
+                logging.exception("reload failed, keep the current index")
+
+
+def run(host=None, port=None):
+    server = RecommendationServer((host or Config.serve_host, port or Config.serve_port),
+                                  result_path(), Config.popular_laws_path)
+    threading.Thread(target=server.watch, args=(Config.serve_reload_interval,), daemon=True).start()
+    logging.info("serving on http://{}:{}".format(*server.server_address))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=Config.serve_host)
+    parser.add_argument("--port", type=int, default=Config.serve_port)
+    args = parser.parse_args()
+    run(args.host, args.port)
@@ -0,0 +1,156 @@
+# -*- "coding: utf-8" -*-
+
+import importlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+class StubRegeoServer(ThreadingHTTPServer):
+    """
+    模拟高德逆地理编码接口的本地服务：按密钥返回成功、失效/超额（infocode）或 HTTP 错误，并记录每次请求的密钥
+    """
+
+    daemon_threads = True
+
+    def __init__(self, behaviours):
+        self.behaviours = behaviours  # 密钥 -> 依次返回的结果（"ok"、infocode 或 HTTP 状态码），用完后返回 "ok"
+        self.calls = []
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), StubRegeoHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/v3/geocode/regeo".format(self.server_address[1])
+
+
+class StubRegeoHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        key = params["key"][0]
+        locations = params["location"][0].split("|")
+        with self.server.lock:
+            self.server.calls.append((key, time.monotonic()))
+            queue = self.server.behaviours.get(key, [])
+            behaviour = queue.pop(0) if queue else "ok"
+        if isinstance(behaviour, int):
+            self.send_response(behaviour)
+            self.end_headers()
+            return
+        if behaviour == "ok":
+            payload = {"status": "1", "regeocodes": [
+                    {"addressComponent": {"province": "广东省", "city": "广州市", "district": location}} for location in locations]}
+        else:
+            payload = {"status": "0", "infocode": behaviour, "info": "stub"}
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def fetch_province(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # 导入时在当前目录打开 log.txt
+    module = importlib.import_module("fetch_province")
+    monkeypatch.setattr(module, "log", io.StringIO())
+    monkeypatch.setattr(module, "retry_backoff", 0.01)
+    return module
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(behaviours=None):
+        servers.append(StubRegeoServer(behaviours or {}))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_regeo_parses_batch(fetch_province, stub):
+    server = stub()
+    client = fetch_province.RegeoClient(fetch_province.KeyPool(["k0"], qps=100), url=server.url)
+    provinces, cities, districts = client.regeo([113.1, 113.2], [23.1, 23.2])
+    assert provinces == ["广东", "广东"]
+    assert cities == ["广州市", "广州市"]
+    assert districts == ["113.1,23.1", "113.2,23.2"]
+
+
+def test_rotates_keys_when_quota_exhausted(fetch_province, stub):
+    server = stub({"k0": ["10003"], "k1": ["10044"]})
+    pool = fetch_province.KeyPool(["k0", "k1", "k2"], qps=100)
+    client = fetch_province.RegeoClient(pool, url=server.url)
+    assert client.regeo([113.1], [23.1])[0] == ["广东"]
+    assert pool.disabled == {"k0", "k1"}
+    assert [key for key, _ in server.calls] == ["k0", "k1", "k2"]
+
+    # 所有密钥都已失效时抛出 QuotaExhausted
+    server.behaviours["k2"] = ["10003"]
+    with pytest.raises(fetch_province.QuotaExhausted):
+        client.regeo([113.1], [23.1])
+
+
+def test_daily_quota_is_enforced_per_key(fetch_province, stub):
+    server = stub()
+    pool = fetch_province.KeyPool(["k0", "k1"], quota=2, qps=100)
+    client = fetch_province.RegeoClient(pool, url=server.url)
+    for _ in range(4):
+        client.regeo([113.1], [23.1])
+    assert pool.report() == {"k0": 2, "k1": 2}
+    with pytest.raises(fetch_province.QuotaExhausted):
+        pool.acquire()
+
+
+def test_retries_with_backoff_then_gives_up(fetch_province, stub):
+    server = stub({"k0": [500, "10004"]})
+    client = fetch_province.RegeoClient(fetch_province.KeyPool(["k0"], qps=100), url=server.url)
+    assert client.regeo([113.1], [23.1])[0] == ["广东"]  # HTTP 错误、访问过于频繁后重试成功
+    assert len(server.calls) == 3
+
+    server.behaviours["k0"] = [500] * (fetch_province.max_retries + 1)
+    assert client.regeo([113.1, 113.2], [23.1, 23.2]) == (["[]", "[]"], ["[]", "[]"], ["[]", "[]"])
+    assert len(server.calls) == 3 + fetch_province.max_retries + 1
+    # 第n次重试前至少等待 retry_backoff * 2**(n-1) 秒
+    times = [called for _, called in server.calls[3:]]
+    for attempt in range(1, len(times)):
+        assert times[attempt] - times[attempt-1] >= fetch_province.retry_backoff * 2**(attempt-1)
+
+
+def test_concurrent_requests_respect_qps_and_keep_order(fetch_province, stub):
+    server = stub()
+    qps = 20
+    pool = fetch_province.KeyPool(["k0", "k1"], qps=qps)
+    client = fetch_province.RegeoClient(pool, url=server.url, pool_size=4)
+    longitudes = [100 + index / 1000 for index in range(200)]
+    latitudes = [30.0] * 200
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        provinces, cities, districts = fetch_province.geocode_concurrently(longitudes, latitudes, client, executor)
+    assert districts == ["{},{}".format(round(longitude, 6), 30.0) for longitude in longitudes]
+
+    # 同一把密钥相邻两次请求的间隔不小于 1/qps（请求到达服务的时间有抖动，留出余量）
+    assert Counter(key for key, _ in server.calls) == {"k0": 5, "k1": 5}
+    for key in ("k0", "k1"):
+        times = sorted(called for called_key, called in server.calls if called_key == key)
+        assert min(later - earlier for earlier, later in zip(times, times[1:])) >= 0.8 / qps
@@ -0,0 +1,73 @@
+# -*- "coding: utf-8" -*-
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from config import Config
+import interaction_store
+
+VIEW_HEADER = "lawId,nameCN,documentNum,industry,username\n"
+DOWNLOAD_HEADER = "lawId,username\n"
+
+
+@pytest.fixture
+def logs(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "view_records_path", str(tmp_path / "lawView.csv"))
+    monkeypatch.setattr(Config, "download_records_path", str(tmp_path / "lawAttachmentDownload.csv"))
+    monkeypatch.setattr(Config, "store_path", str(tmp_path / "interaction_store.npz"))
+    monkeypatch.setattr(Config, "reader_workers", 1)
+    interaction_store._cache.clear()
+    yield tmp_path
+    interaction_store._cache.clear()
+
+
+def _write(path, text, mode="w"):
+    with open(path, mode, encoding="utf-8") as f:
+        f.write(text)
+
+
+def _law_metadata(store):
+    return dict(zip(store["laws"].tolist(), zip(store["law_names"].tolist(), store["law_nums"].tolist())))
+
+
+def test_update_fills_metadata_of_law_first_seen_in_downloads(logs):
+    _write(Config.view_records_path, VIEW_HEADER + "A,NameA,GB-A,建筑,u1\n")
+    _write(Config.download_records_path, DOWNLOAD_HEADER + "B,u1\n")
+    interaction_store.build_store()
+    assert _law_metadata(interaction_store.load_store())["B"] == ("", "")
+
+    # 追加 B 的第一条浏览记录，以及一条名称不同的后续记录（应取首次出现的名称）
+    _write(Config.view_records_path, "B,NameB,GB-B,化工,u2\nB,Other,GB-X,化工,u3\n", "a")
+    stat = os.stat(Config.store_path)
+    os.utime(Config.view_records_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    updated = _law_metadata(interaction_store.load_store())
+
+    interaction_store.build_store()
+    rebuilt = _law_metadata(interaction_store.load_store())
+    assert updated == rebuilt
+    assert updated["B"] == ("NameB", "GB-B")
+
+
+def test_update_matches_rebuild_with_small_chunks(logs, monkeypatch):
+    monkeypatch.setattr(Config, "chunk_bytes", 16)
+    views = ["L{0},Name{0},GB{0},行业{1},u{2}\n".format(i % 7, i % 3, i % 5) for i in range(40)]
+    downloads = ["L{},u{}\n".format(i % 11, i % 4) for i in range(20)]
+    _write(Config.view_records_path, VIEW_HEADER + "".join(views[:15]))
+    _write(Config.download_records_path, DOWNLOAD_HEADER + "".join(downloads[:10]))
+    interaction_store.build_store()
+
+    _write(Config.view_records_path, "".join(views[15:]), "a")
+    _write(Config.download_records_path, "".join(downloads[10:]), "a")
+    assert not interaction_store.update_store()["rebuilt"]
+    updated = dict(interaction_store.load_store())
+
+    interaction_store.build_store()
+    rebuilt = interaction_store.load_store()
+    assert _law_metadata(updated) == _law_metadata(rebuilt)
+    assert sorted(zip(updated["users"][updated["user_id"]], updated["laws"][updated["law_id"]], updated["source"])) \
+        == sorted(zip(rebuilt["users"][rebuilt["user_id"]], rebuilt["laws"][rebuilt["law_id"]], rebuilt["source"]))